@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
+"""Summarize hyperfine results for each interpreter mode.
+
+Reads the `*.bench.json` files that hyperfine writes, computes each
+benchmark's speedup over the baseline mode with a bootstrap confidence
+interval from the individual `times`, and writes a CSV (and optionally
+JSON) for `plot.vl.json`. The overall speedup of each mode, the harmonic
+mean over benchmarks, goes to stderr with its own confidence interval.
+"""
+import argparse
 import json
 import sys
 import os
 import csv
+import random
 import statistics
 import re
-from collections import defaultdict
 
 MODES = {
     'brili': r'\bbrili\b',
@@ -14,6 +23,8 @@ MODES = {
     'brilift-aot': r'^\./[^/]+ '
 }
 BASELINE = 'brili'
+COLUMNS = ['bench', 'mode', 'mean', 'stddev', 'speedup', 'speedup_low',
+           'speedup_high']
 
 
 def get_results(bench_files):
@@ -27,42 +38,167 @@ def get_results(bench_files):
                 if re.search(pat, res['command']):
                     break
             else:
-                assert False, "unknown benchmark command"
+                print('{}: skipping unknown command: {}'.format(
+                    fn, res['command']
+                ), file=sys.stderr)
+                continue
 
             yield bench, mode, res
 
 
-def summarize(bench_files):
-    means = defaultdict(dict)
-    results = list(get_results(bench_files))
-    for bench, mode, res in results:
-        means[bench][mode] = res['mean']
+def load_times(bench_files):
+    """Collect the timing samples for every benchmark and mode.
+
+    Return the list of benchmark names and a dict mapping each mode to a
+    list, parallel to the benchmarks, of that mode's `times` (or None
+    where the mode didn't run).
+    """
+    benches = []
+    times = {mode: [] for mode in MODES}
+    for bench, mode, res in get_results(bench_files):
+        if bench not in benches:
+            benches.append(bench)
+            for column in times.values():
+                column.append(None)
+        # Older hyperfine versions only report the mean.
+        times[mode][benches.index(bench)] = res.get('times') or \
+            [res['mean']]
+    return benches, times
+
+
+def resample_means(samples, resamples, rng):
+    return [statistics.fmean(rng.choices(samples, k=len(samples)))
+            for _ in range(resamples)]
+
+
+def percentiles(values, confidence):
+    values = sorted(values)
+    tail = (1 - confidence) / 2
+    return (values[int(tail * (len(values) - 1))],
+            values[int((1 - tail) * (len(values) - 1))])
+
+
+def summarize_mode(base, samples, resamples, confidence, rng):
+    """Compute speedups of one mode over the baseline.
+
+    `base` and `samples` are parallel lists of timing samples (or None).
+    Return per-benchmark lists of the speedup and the bounds of its
+    confidence interval (None where either mode is missing), and the
+    overall harmonic mean speedup with its interval (or None).
+    """
+    speedup, low, high = [], [], []
+    replicates = []
+    for base_times, mode_times in zip(base, samples):
+        if not base_times or not mode_times:
+            speedup.append(None)
+            low.append(None)
+            high.append(None)
+            continue
 
-    writer = csv.DictWriter(
-        sys.stdout,
-        ['bench', 'mode', 'mean', 'stddev', 'speedup'],
-    )
+        # Resample each benchmark's means to get a distribution of its
+        # speedup, keeping the replicates for the overall interval. The
+        # baseline's samples are the same for both means, so its speedup
+        # over itself is exactly 1.
+        if mode_times is base_times:
+            reps = [1.0] * resamples
+        else:
+            reps = [b / m for b, m in zip(
+                resample_means(base_times, resamples, rng),
+                resample_means(mode_times, resamples, rng),
+            )]
+        replicates.append(reps)
+        speedup.append(statistics.fmean(base_times) /
+                       statistics.fmean(mode_times))
+        lo, hi = percentiles(reps, confidence)
+        low.append(lo)
+        high.append(hi)
+
+    if not replicates:
+        return speedup, low, high, None
+    overall = statistics.harmonic_mean([s for s in speedup if s])
+    overall_reps = [statistics.harmonic_mean(reps)
+                    for reps in zip(*replicates)]
+    return speedup, low, high, \
+        (overall,) + percentiles(overall_reps, confidence)
+
+
+def summarize(bench_files, baseline=BASELINE, json_file=None,
+              resamples=1000, confidence=0.95):
+    benches, times = load_times(bench_files)
+    base = times[baseline]
+    missing = [b for b, t in zip(benches, base) if not t]
+    if missing:
+        print('no {} baseline for: {}'.format(baseline, ' '.join(missing)),
+              file=sys.stderr)
+
+    # A fixed seed makes the intervals reproducible.
+    rng = random.Random(0)
+    rows = []
+    overall = {}
+    for mode, samples in times.items():
+        if not any(samples):
+            continue
+        speedup, low, high, total = summarize_mode(
+            base, samples, resamples, confidence, rng,
+        )
+        for i, bench in enumerate(benches):
+            if not samples[i]:
+                continue
+            if speedup[i]:
+                print('{} {} {:.2f}x'.format(bench, mode, speedup[i]),
+                      file=sys.stderr)
+            rows.append({
+                'bench': bench,
+                'mode': mode,
+                'mean': statistics.fmean(samples[i]),
+                'stddev': statistics.stdev(samples[i])
+                if len(samples[i]) > 1 else 0.0,
+                'speedup': speedup[i],
+                'speedup_low': low[i],
+                'speedup_high': high[i],
+            })
+
+        count = sum(1 for s in speedup if s)
+        if total:
+            overall[mode] = dict(zip(['speedup', 'low', 'high'], total),
+                                 benchmarks=count)
+            print('{}: {:.2f}x ({:.0%} CI {:.2f}x-{:.2f}x, {} benchmarks)'
+                  .format(mode, total[0], confidence, total[1], total[2],
+                          count), file=sys.stderr)
+        else:
+            overall[mode] = {'speedup': None, 'benchmarks': 0}
+            print('{}: no benchmarks with a baseline'.format(mode),
+                  file=sys.stderr)
+
+    writer = csv.DictWriter(sys.stdout, COLUMNS)
     writer.writeheader()
-    speedups = {k: [] for k in MODES}
-    for bench, mode, res in results:
-        speedup = means[bench][BASELINE] / res['mean']
-        print('{} {} {:.2f}x'.format(bench, mode, speedup), file=sys.stderr)
-        speedups[mode].append(speedup)
-
-        writer.writerow({
-            'bench': bench,
-            'mode': mode,
-            'mean': res['mean'],
-            'stddev': res['stddev'],
-            'speedup': speedup,
-        })
-
-    for mode, speedup_list in speedups.items():
-        print('{}: {:.2f}x'.format(
-            mode,
-            statistics.harmonic_mean(speedup_list)
-        ), file=sys.stderr)
+    writer.writerows(rows)
+
+    if json_file:
+        json.dump({
+            'baseline': baseline,
+            'confidence': confidence,
+            'benchmarks': rows,
+            'modes': overall,
+        }, json_file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*', help='hyperfine JSON files')
+    parser.add_argument('--baseline', default=BASELINE, choices=MODES,
+                        help='mode to compute speedups over '
+                             '(default: {})'.format(BASELINE))
+    parser.add_argument('--json', type=argparse.FileType('w'),
+                        metavar='FILE', help='also write JSON to this file')
+    parser.add_argument('--resamples', type=int, default=1000,
+                        help='bootstrap resamples (default: 1000)')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='confidence level (default: 0.95)')
+    args = parser.parse_args()
+    summarize(args.files, args.baseline, args.json, args.resamples,
+              args.confidence)
 
 
 if __name__ == '__main__':
-    summarize(sys.argv[1:])
+    main()
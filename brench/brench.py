@@ -1,6 +1,7 @@
 """Simple comparative benchmark runner.
 """
 
+import asyncio
 import click
 import tomlkit
 import subprocess
@@ -9,54 +10,1048 @@ import csv
 import sys
 import os
 from concurrent import futures
+import codecs
+import functools
 import glob
+import hashlib
+import random
+import resource
+import shutil
+import statistics
+import importlib
+import importlib.util
+import io
+import json
+import locale
+import shlex
+import signal
+import socket
+import tempfile
+import threading
+import time
+import traceback
+from collections import deque, namedtuple
 
 __version__ = '1.0.0'
 
 ARGS_RE = r'ARGS: (.*)'
+STATS_COLUMNS = ['mean', 'median', 'stddev', 'min', 'ci_low', 'ci_high']
 
+# A stage that fails under a memory limit counts as running out of memory
+# if the end of its stderr matches this, like a failed allocation would
+# report it. (V8, which runs `brili`, says "JavaScript heap out of memory"
+# or "Fatal process OOM".)
+OOM_RE = re.compile(
+    r'MemoryError|std::bad_alloc|memory allocation of \d+ bytes failed|'
+    r'out of memory|Fatal process OOM|Cannot allocate memory',
+    re.IGNORECASE,
+)
 
-def run_pipe(cmds, input, timeout):
+# How much of the end of each stage's stderr to check for `OOM_RE`, in
+# characters.
+STDERR_TAIL = 4096
+
+# A shell that stops itself so its limits can be set before it runs the
+# stage's command (given as `$1`).
+STOPPED_SHELL = 'kill -STOP $$ && exec /bin/sh -c "$1"'
+
+# Bump this when the format of cached results changes.
+CACHE_VERSION = 8
+
+# How often `brench work` processes tell the coordinator they're alive,
+# in seconds.
+HEARTBEAT_INTERVAL = 2.0
+
+# The longest message the coordinator accepts from a worker.
+MESSAGE_LIMIT = 1 << 30
+
+# Output digests record a checkpoint of their hash every this many
+# tokens, each this many bytes long.
+DIGEST_BLOCK = 16
+CHECKPOINT_BYTES = 8
+
+# One measured execution of a pipeline. `stdout` is a digest of the
+# standard output (see `OutputDigest`), `stages` is a list of resource
+# usage dicts, one per pipeline stage (see `stage_usage`), and `cpu` is
+# the CPU the pipeline was pinned to, if any.
+Sample = namedtuple('Sample', ['stdout', 'stderr', 'seconds', 'stages', 'cpu'],
+                    defaults=[None])
+PYTHON_STAGE = 'python:'
+
+_stage_lock = threading.Lock()
+_stage_funcs = {}
+
+
+def stage_usage(cmd, wall, rusage, exit=None, oom=False):
+    """Summarize the resources used by a pipeline stage as a dict.
+
+    `rusage` is a `resource.struct_rusage` or None. Peak RSS is in
+    kilobytes. `exit` is the stage's return code, which is negative if
+    it was killed by a signal. `oom` says whether it ran out of memory.
+    """
+    usage = {'cmd': cmd, 'wall': wall, 'user': None, 'sys': None,
+             'maxrss_kb': None, 'exit': exit, 'oom': oom}
+    if rusage:
+        usage['user'] = rusage.ru_utime
+        usage['sys'] = rusage.ru_stime
+        # macOS reports bytes; everyone else reports kilobytes.
+        usage['maxrss_kb'] = rusage.ru_maxrss // 1024 \
+            if sys.platform == 'darwin' else rusage.ru_maxrss
+    return usage
+
+
+class _Waiter(threading.Thread):
+    """Reap a pipeline stage as soon as it exits, recording its
+    wall-clock time since `start` and its resource usage (and setting
+    its `returncode`).
+    """
+    def __init__(self, proc, start):
+        super().__init__(daemon=True)
+        self.proc = proc
+        self.start_time = start
+        self.wall = None
+        self.rusage = None
+        self.start()
+
+    def run(self):
+        _, status, self.rusage = os.wait4(self.proc.pid, 0)
+        self.wall = time.perf_counter() - self.start_time
+        # Let `Popen` know that the process is gone.
+        self.proc.returncode = os.waitstatus_to_exitcode(status)
+
+
+def _spawn(cmd, memory_limit=None, cpu_limit=None, cpu=None, **kwargs):
+    """Start a shell command as a `Popen` in its own process group.
+
+    The command can be limited to `memory_limit` bytes of data (its heap
+    and other private memory) and `cpu_limit` seconds of CPU time, and
+    pinned to a `cpu`. To set these without running Python code between
+    `fork` and `exec`, the shell stops itself first, and the limits are
+    applied to it from the outside with `prlimit` before it continues.
+    """
+    if not memory_limit and not cpu_limit and cpu is None:
+        return subprocess.Popen(cmd, shell=True, start_new_session=True,
+                                **kwargs)
+
+    proc = subprocess.Popen(['/bin/sh', '-c', STOPPED_SHELL, 'sh', cmd],
+                            start_new_session=True, **kwargs)
+    os.waitid(os.P_PID, proc.pid, os.WSTOPPED | os.WEXITED | os.WNOWAIT)
+    try:
+        if cpu is not None:
+            os.sched_setaffinity(proc.pid, {cpu})
+        if memory_limit:
+            # Not `RLIMIT_AS`: V8 reserves more address space than
+            # that at startup, so `brili` couldn't run at all.
+            resource.prlimit(proc.pid, resource.RLIMIT_DATA,
+                             (memory_limit, memory_limit))
+        if cpu_limit:
+            # Exceeding the soft limit sends SIGXCPU; the hard limit,
+            # SIGKILL.
+            secs = int(-(-cpu_limit // 1))
+            resource.prlimit(proc.pid, resource.RLIMIT_CPU,
+                             (secs, secs + 1))
+    except BaseException:
+        _kill_group(proc)
+        proc.wait()
+        raise
+    os.kill(proc.pid, signal.SIGCONT)
+    return proc
+
+
+def _out_of_memory(exit, stderr, memory_limit):
+    """Check whether a stage that exited with status `exit` under a
+    memory limit failed to allocate memory, given the end of its stderr.
+    """
+    return bool(memory_limit and exit and OOM_RE.search(stderr))
+
+
+def _kill_group(proc):
+    """Kill a stage's entire process group, including any processes it
+    started in the background.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_pipe(cmds, input, timeout, usage=None, memory_limit=None,
+             cpu_limit=None, cpu=None, sink=None):
     """Execute a pipeline of shell commands.
 
     Send the given input (text) string into the first command, then pipe
     the output of each command into the next command in the sequence.
     Collect and return the stdout and stderr from the final command.
+
+    Each command runs in its own process group, which is killed when
+    the pipeline finishes or times out, so no stray descendants survive.
+    Each command can be limited to `memory_limit` bytes of data and
+    `cpu_limit` seconds of CPU time, and pinned to a `cpu` (see
+    `_spawn`).
+
+    If a `usage` list is given, append a `stage_usage` dict for each
+    command with its wall-clock time, CPU time, peak memory, and exit
+    status, and whether its stderr says it ran out of memory.
+
+    If a `sink` (like an `OutputDigest`) is given, feed the final
+    command's stdout to it as it arrives, and return None in its place.
     """
+    deadline = time.monotonic() + timeout
     procs = []
+    waiters = []
     for cmd in cmds:
-        last = len(procs) == len(cmds) - 1
-        proc = subprocess.Popen(
-            cmd,
-            shell=True,
+        start = time.perf_counter()
+        proc = _spawn(
+            cmd, memory_limit, cpu_limit, cpu,
             text=True,
             stdin=procs[-1].stdout if procs else subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE if last else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
         )
+        if procs:
+            procs[-1].stdout.close()  # Only the next stage reads this.
         procs.append(proc)
+        waiters.append(_Waiter(proc, start))
 
     try:
-        # Send stdin and collect stdout.
-        procs[0].stdin.write(input)
-        procs[0].stdin.close()
-        return procs[-1].communicate(timeout=timeout)
+        # Send stdin and collect stdout and stderr (and the end of the
+        # other stages' stderr), using threads so that no pipe can fill
+        # up and block.
+        outputs = {}
+
+        def read(name, stream):
+            outputs[name] = stream.read()
+            stream.close()
+
+        def read_tail(name, stream):
+            outputs[name] = ''
+            for chunk in iter(lambda: stream.read(1 << 16), ''):
+                outputs[name] = (outputs[name] + chunk)[-STDERR_TAIL:]
+            stream.close()
+
+        def feed(name, stream):
+            for chunk in iter(lambda: stream.read(1 << 16), ''):
+                sink.feed(chunk)
+            outputs[name] = None
+            stream.close()
+
+        def write():
+            try:
+                procs[0].stdin.write(input)
+                procs[0].stdin.close()
+            except BrokenPipeError:
+                pass
+
+        threads = [
+            threading.Thread(target=write, daemon=True),
+            threading.Thread(target=feed if sink else read,
+                             args=('stdout', procs[-1].stdout), daemon=True),
+            threading.Thread(target=read, args=('stderr', procs[-1].stderr),
+                             daemon=True),
+        ]
+        tails = [
+            threading.Thread(target=read_tail, args=(i, proc.stderr),
+                             daemon=True)
+            for i, proc in enumerate(procs[:-1])
+        ]
+        for thread in threads + tails:
+            thread.start()
+        for thread in threads[1:] + waiters:
+            thread.join(max(deadline - time.monotonic(), 0))
+            if thread.is_alive():
+                raise subprocess.TimeoutExpired(cmds, timeout)
     finally:
+        # Each stage leads its own process group, so this kills it too.
         for proc in procs:
-            proc.kill()
+            _kill_group(proc)
+        for waiter in waiters:
+            waiter.join()
 
+    if usage is not None:
+        outputs[len(procs) - 1] = outputs['stderr'][-STDERR_TAIL:]
+        for i, (cmd, waiter) in enumerate(zip(cmds, waiters)):
+            # A background process may still hold a stderr open.
+            if i < len(tails):
+                tails[i].join(max(deadline - time.monotonic(), 0))
+            exit = waiter.proc.returncode
+            oom = _out_of_memory(exit, outputs.get(i, ''), memory_limit)
+            usage.append(stage_usage(cmd, waiter.wall, waiter.rusage, exit,
+                                     oom))
+    return outputs['stdout'], outputs['stderr']
 
-def compare_output(o1, o2, ε=0.0):
-    def my_compare(x, y):
+
+async def _wait_async(proc, start):
+    """Wait on the running event loop for a process to exit and reap it
+    with `os.wait4`, setting its `returncode`. Return its wall-clock
+    time since `start` and its resource usage.
+
+    A pidfd tells the loop when the process exits. Without one (before
+    Linux 5.3), poll for it instead.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+
+    if pidfd is None:
+        delay = 0.0001
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                end = time.perf_counter()
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.01)
+    else:
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or
+                        exited.set_result(time.perf_counter()))
         try:
-            return abs(float(x) - float(y)) <= ε
-        except ValueError:
-            return x == y
-    return all(my_compare(x, y) for x, y in zip(o1.split(), o2.split()))
+            end = await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        _, status, rusage = os.wait4(proc.pid, 0)
 
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return end - start, rusage
 
-def run_bench(pipeline, fn, timeout):
-    """Run a single benchmark pipeline.
+
+async def run_pipe_async(cmds, input, timeout, usage=None, memory_limit=None,
+                         cpu_limit=None, cpu=None, sink=None):
+    """Execute a pipeline of shell commands on the running event loop.
+
+    Works like `run_pipe`, but the input and output are streamed by the
+    event loop, and the stages are reaped there as they exit, so no
+    threads are needed.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    procs = []
+    starts = []
+    transports = []
+    reaped = {}
+    tails = []
+
+    async def reader(pipe):
+        stream = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(stream), pipe,
+        )
+        transports.append(transport)
+        return stream
+
+    async def write():
+        transport, _ = await loop.connect_write_pipe(asyncio.Protocol,
+                                                     procs[0].stdin)
+        transports.append(transport)
+        # Closing the transport sends EOF once the data is written. A
+        # stage that exits without reading it all makes that fail
+        # quietly.
+        transport.write(input.encode(locale.getpreferredencoding(False)))
+        transport.close()
+
+    async def reap(proc, start):
+        reaped[proc.pid] = await _wait_async(proc, start)
+
+    async def read_tail(stream):
+        tail = b''
+        while chunk := await stream.read(1 << 16):
+            tail = (tail + chunk)[-STDERR_TAIL:]
+        return tail.decode(errors='replace')
+
+    async def feed(stream):
+        # Decode like `Popen` does in text mode.
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(locale.getpreferredencoding(False))(),
+            translate=True,
+        )
+        while True:
+            chunk = await stream.read(1 << 16)
+            sink.feed(decoder.decode(chunk, final=not chunk))
+            if not chunk:
+                return None
+
+    async def communicate():
+        await write()
+        for proc in procs[:-1]:
+            tails.append(asyncio.ensure_future(
+                read_tail(await reader(proc.stderr))
+            ))
+        stdout = await reader(procs[-1].stdout)
+        stderr = await reader(procs[-1].stderr)
+        stdout, stderr, *_ = await asyncio.gather(
+            feed(stdout) if sink else stdout.read(), stderr.read(),
+            *(reap(proc, start) for proc, start in zip(procs, starts)),
+        )
+        return stdout, stderr
+
+    try:
+        for cmd in cmds:
+            starts.append(time.perf_counter())
+            proc = _spawn(
+                cmd, memory_limit, cpu_limit, cpu,
+                stdin=procs[-1].stdout if procs else subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            if procs:
+                procs[-1].stdout.close()  # Only the next stage reads this.
+            procs.append(proc)
+
+        stdout, stderr = await asyncio.wait_for(communicate(), timeout)
+        # A background process may still hold a stderr open.
+        if tails:
+            await asyncio.wait(tails, timeout=max(deadline - loop.time(), 0))
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(cmds, timeout)
+    finally:
+        # Each stage leads its own process group, so this kills it too.
+        for proc in procs:
+            _kill_group(proc)
+        for transport in transports:
+            transport.close()
+        for proc, start in zip(procs, starts):
+            if proc.pid not in reaped:
+                await reap(proc, start)
+
+    stderr = _decode(stderr)
+    if usage is not None:
+        ends = [tail.result() if tail.done() else '' for tail in tails]
+        ends.append(stderr[-STDERR_TAIL:])
+        for cmd, proc, end in zip(cmds, procs, ends):
+            wall, rusage = reaped[proc.pid]
+            oom = _out_of_memory(proc.returncode, end, memory_limit)
+            usage.append(stage_usage(cmd, wall, rusage, proc.returncode,
+                                     oom))
+    return None if sink else _decode(stdout), stderr
+
+
+def _decode(data):
+    """Decode process output like `Popen` does in text mode."""
+    return io.TextIOWrapper(io.BytesIO(data)).read()
+
+
+def load_stage(spec):
+    """Import the function for an in-process stage.
+
+    `spec` looks like `module:function`, where `module` is either a
+    module name or a path to a `.py` file. Each function is imported
+    only once per process.
+    """
+    with _stage_lock:
+        if spec in _stage_funcs:
+            return _stage_funcs[spec]
+
+        module_name, func_name = spec.rsplit(':', 1)
+        if module_name.endswith('.py'):
+            # Load from a file. Put its directory on the path so it can
+            # import its neighbors.
+            path = os.path.abspath(module_name)
+            dirname = os.path.dirname(path)
+            if dirname not in sys.path:
+                sys.path.insert(0, dirname)
+            mod_spec = importlib.util.spec_from_file_location(
+                'brench_stage_{}'.format(len(_stage_funcs)), path,
+            )
+            module = importlib.util.module_from_spec(mod_spec)
+            mod_spec.loader.exec_module(module)
+        else:
+            module = importlib.import_module(module_name)
+
+        func = _stage_funcs[spec] = getattr(module, func_name)
+        return func
+
+
+def run_python_stage(cmd, prog):
+    """Run an in-process stage, written `python:module:function args`.
+
+    The function is called with the program (as JSON data) followed by
+    the arguments, as strings. It may return a new program or modify
+    the program in place and return None.
+    """
+    spec, *args = shlex.split(cmd[len(PYTHON_STAGE):])
+    func = load_stage(spec)
+    out = func(prog, *args)
+    return prog if out is None else out
+
+
+def _thread_rusage():
+    """Get the resource usage of the current thread, where supported."""
+    if hasattr(resource, 'RUSAGE_THREAD'):
+        return resource.getrusage(resource.RUSAGE_THREAD)
+    return None
+
+
+def _segments(cmds):
+    """Split a pipeline into single in-process stages and runs of
+    consecutive shell commands. Generate `(start, end)` index pairs.
+    """
+    i = 0
+    while i < len(cmds):
+        j = i + 1
+        if not cmds[i].startswith(PYTHON_STAGE):
+            while j < len(cmds) and not cmds[j].startswith(PYTHON_STAGE):
+                j += 1
+        yield i, j
+        i = j
+
+
+def _python_stage(cmd, data, usage, cpu=None):
+    """Run an in-process stage on a program, given as JSON text or data.
+
+    Append its `stage_usage` to `usage` if it's a list. If `cpu` is not
+    None, pin the calling thread to it while the stage runs. Return the
+    new program and None, or None and a traceback if the stage failed.
+    """
+    if cpu is not None:
+        affinity = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, {cpu})
+    start = time.perf_counter()
+    before = _thread_rusage()
+    try:
+        if isinstance(data, str):
+            data = json.loads(data)
+        data = run_python_stage(cmd, data)
+    except Exception:
+        return None, traceback.format_exc()
+    finally:
+        if cpu is not None:
+            os.sched_setaffinity(0, affinity)
+    if usage is not None:
+        after = _thread_rusage()
+        stage = stage_usage(cmd, time.perf_counter() - start, None)
+        if before and after:
+            stage['user'] = after.ru_utime - before.ru_utime
+            stage['sys'] = after.ru_stime - before.ru_stime
+        usage.append(stage)
+    return data, None
+
+
+def run_pipeline(cmds, input, timeout, usage=None, memory_limit=None,
+                 cpu_limit=None, cpu=None, digest=None):
+    """Execute a pipeline that may mix shell commands and in-process
+    Python stages.
+
+    Runs of consecutive shell commands are executed with `run_pipe`.
+    Python stages get the program as JSON data directly, so a sequence
+    of them never serializes the program in between. Return the stdout
+    and stderr from the final stage.
+
+    If a `usage` list is given, append a `stage_usage` dict for each
+    stage. For in-process stages, the CPU times are for the calling
+    thread (on Linux) and the peak RSS is unknown.
+
+    Shell commands are subject to `memory_limit` (in bytes) and
+    `cpu_limit` (in seconds); in-process stages are not. Nor can the
+    `timeout` interrupt an in-process stage: it is only checked once the
+    stage returns. All stages are pinned to `cpu` if it is not None.
+
+    If an `OutputDigest` is given, the final stage's stdout streams into
+    it, and None is returned in its place.
+    """
+    deadline = time.monotonic() + timeout
+    data = input
+    stderr = ''
+    for i, j in _segments(cmds):
+        if cmds[i].startswith(PYTHON_STAGE):
+            data, error = _python_stage(cmds[i], data, usage, cpu)
+            if error:
+                return '', error
+            stderr = ''
+            if time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(cmds[i], timeout)
+        else:
+            if not isinstance(data, str):
+                data = json.dumps(data)
+            data, stderr = run_pipe(cmds[i:j], data,
+                                    max(deadline - time.monotonic(), 0),
+                                    usage, memory_limit, cpu_limit, cpu,
+                                    digest if j == len(cmds) else None)
+
+    return _pipeline_output(data, digest), stderr
+
+
+def _pipeline_output(data, digest):
+    """Get the output of a pipeline's final stage as text or, if it was
+    an in-process stage, feed it into the `digest`.
+    """
+    if data is not None and not isinstance(data, str):
+        data = json.dumps(data, indent=2, sort_keys=True)
+    if digest and data is not None:
+        digest.feed(data)
+        return None
+    return data
+
+
+async def run_pipeline_async(cmds, input, timeout, usage=None,
+                             memory_limit=None, cpu_limit=None, cpu=None,
+                             digest=None):
+    """Execute a pipeline like `run_pipeline`, on the running event loop.
+
+    Shell commands run with `run_pipe_async`, and in-process stages run
+    in a worker thread so they don't block the loop.
+    """
+    deadline = time.monotonic() + timeout
+    data = input
+    stderr = ''
+    for i, j in _segments(cmds):
+        if cmds[i].startswith(PYTHON_STAGE):
+            data, error = await asyncio.to_thread(_python_stage, cmds[i],
+                                                  data, usage, cpu)
+            if error:
+                return '', error
+            stderr = ''
+            if time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(cmds[i], timeout)
+        else:
+            if not isinstance(data, str):
+                data = json.dumps(data)
+            data, stderr = await run_pipe_async(
+                cmds[i:j], data, max(deadline - time.monotonic(), 0),
+                usage, memory_limit, cpu_limit, cpu,
+                digest if j == len(cmds) else None,
+            )
+
+    return _pipeline_output(data, digest), stderr
+
+
+class OutputDigest:
+    """Summarize a program's output as it streams in, without keeping it.
+
+    The output is split into whitespace-separated tokens, which feed a
+    running hash. After every `DIGEST_BLOCK` tokens, a checkpoint of the
+    hash is saved, so `compare_digests` can find roughly where two
+    outputs diverge. With `keep_tokens`, the tokens themselves are kept
+    too, for approximate comparisons. With an `extract_re`, the first
+    match of its first group is saved (though a match that spans lines
+    may be missed).
+    """
+    # Don't let an output with no newlines pile up.
+    MAX_LINE = 1 << 20
+
+    def __init__(self, extract_re=None, keep_tokens=False):
+        self.extract_re = re.compile(extract_re) if extract_re else None
+        self.hash = hashlib.blake2b(digest_size=16)
+        self.count = 0
+        self.checkpoints = bytearray()
+        self.tokens = [] if keep_tokens else None
+        self.match = None
+        self.partial = ''
+
+    def feed(self, text):
+        # Process complete lines and keep the rest for later.
+        text = self.partial + text
+        end = text.rfind('\n') + 1
+        if not end and len(text) > self.MAX_LINE:
+            end = text.rfind(' ') + 1
+        self.partial = text[end:]
+        if end:
+            self._add(text[:end])
+
+    def _add(self, text):
+        if self.extract_re and self.match is None:
+            match = self.extract_re.search(text)
+            if match:
+                self.match = match.group(1)
+
+        tokens = text.split()
+        if self.tokens is not None:
+            self.tokens += tokens
+        i = 0
+        while i < len(tokens):
+            end = i + DIGEST_BLOCK - self.count % DIGEST_BLOCK
+            block = tokens[i:end]
+            self.hash.update('\0'.join(block).encode() + b'\0')
+            self.count += len(block)
+            i = end
+            if self.count % DIGEST_BLOCK == 0:
+                self.checkpoints += self.hash.digest()[:CHECKPOINT_BYTES]
+
+    def result(self):
+        """Finish the output and return the digest as a JSON-friendly
+        dict.
+        """
+        self._add(self.partial)
+        self.partial = ''
+        return {
+            'count': self.count,
+            'hash': self.hash.hexdigest(),
+            'checkpoints': self.checkpoints.hex(),
+            'tokens': self.tokens,
+            'match': self.match,
+        }
+
+
+def _same_token(x, y, ε):
+    try:
+        return abs(float(x) - float(y)) <= ε
+    except ValueError:
+        return x == y
+
+
+def compare_digests(ref, out, ε=0.0):
+    """Compare two outputs by their `OutputDigest` results.
+
+    Return None if they match, or the index of the first token where
+    they differ. When only hashes are available, that index is the start
+    of the first `DIGEST_BLOCK` of tokens that differs. Numeric tokens
+    match if they are within ε of each other, which requires both
+    digests to have kept their tokens.
+    """
+    if ref['tokens'] is not None and out['tokens'] is not None:
+        for i, (x, y) in enumerate(zip(ref['tokens'], out['tokens'])):
+            if not _same_token(x, y, ε):
+                return i
+        if len(ref['tokens']) != len(out['tokens']):
+            return min(len(ref['tokens']), len(out['tokens']))
+        return None
+
+    if ref['count'] == out['count'] and ref['hash'] == out['hash']:
+        return None
+    a = bytes.fromhex(ref['checkpoints'])
+    b = bytes.fromhex(out['checkpoints'])
+    common = min(len(a), len(b)) // CHECKPOINT_BYTES
+    for i in range(common):
+        chunk = slice(i * CHECKPOINT_BYTES, (i + 1) * CHECKPOINT_BYTES)
+        if a[chunk] != b[chunk]:
+            return i * DIGEST_BLOCK
+    return common * DIGEST_BLOCK
+
+
+def file_hash(path):
+    """Get the SHA-256 hash of a file's contents, as a hex string."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def command_files(cmd):
+    """Find the files that a shell command runs: its executable, if it
+    can be found on the `PATH`, and any arguments that are files (like a
+    script for an interpreter).
+    """
+    try:
+        words = shlex.split(cmd)
+    except ValueError:
+        return []
+    files = [w for w in words if os.path.isfile(w)]
+    if words and words[0] not in files and shutil.which(words[0]):
+        files.append(words[0])
+    return files
+
+
+def tool_hashes(config):
+    """Hash the tools that the results depend on.
+
+    These are the files listed in the `tools` config option (which can
+    be paths or commands on the `PATH`), the `.py` files of in-process
+    stages, and the files that shell stages run (see `command_files`).
+    Return a sorted list of `(tool, hash)` pairs.
+    """
+    tools = set(config.get('tools', []))
+    for run in config['runs'].values():
+        for cmd in run['pipeline']:
+            if cmd.startswith(PYTHON_STAGE):
+                module = shlex.split(cmd[len(PYTHON_STAGE):])[0]
+                module = module.rsplit(':', 1)[0]
+                if module.endswith('.py'):
+                    tools.add(module)
+            else:
+                tools.update(command_files(cmd))
+
+    hashes = []
+    for tool in sorted(tools):
+        path = tool if os.path.exists(tool) else shutil.which(tool)
+        if not path:
+            raise click.UsageError('tool not found: {}'.format(tool))
+        hashes.append((tool, file_hash(path)))
+    return hashes
+
+
+class ResultCache:
+    """An on-disk cache of benchmark results.
+
+    Entries are JSON files named by the hash of everything that
+    determines a result. When the cache grows past `max_bytes`, `evict`
+    removes the least recently used entries.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, *parts):
+        data = json.dumps(parts, sort_keys=True).encode('utf8')
+        return hashlib.sha256(data).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)  # Mark as recently used.
+        except FileNotFoundError:
+            pass  # Another process evicted it meanwhile.
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        path = self._entry_path(key)
+        # Other threads and processes may be writing the same entry, or
+        # evicting the shard's last entry and removing its directory.
+        while True:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                           suffix='.tmp')
+                break
+            except FileNotFoundError:
+                continue
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits."""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                if name.endswith('.json'):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue  # Another process evicted it.
+                    entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass  # The shard still has other entries.
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'brench')
+
+
+class SharedPrefixes:
+    """Run the leading stages that several runs of one benchmark have in
+    common only once.
+
+    `runs` maps run names to `(pipeline, memory_limit, cpu_limit)`. Each
+    run whose first stages (and limits) match another run's starts from
+    the output of the longest such prefix, leaving at least its last
+    stage to run itself. Prefixes are computed on first use, and each
+    one starts from the output of the longest shorter prefix that is
+    itself shared, so runs that branch apart at different points still
+    share their common start.
+    """
+    def __init__(self, fn, runs):
+        self.fn = fn
+        members = {}
+        for name, (pipeline, *limits) in runs.items():
+            for k in range(1, len(pipeline)):
+                key = (tuple(pipeline[:k]), *limits)
+                members.setdefault(key, []).append(name)
+
+        # Find the longest shared prefix for each run.
+        self.keys = {}
+        self.runs = {}
+        for name, (pipeline, *limits) in runs.items():
+            for k in range(len(pipeline) - 1, 0, -1):
+                key = (tuple(pipeline[:k]), *limits)
+                if len(members[key]) > 1:
+                    self.keys[name] = key
+                    self.runs[key] = members[key]
+                    break
+
+        self.locks = {key: threading.Lock() for key in self.runs}
+        self.results = {}
+        self.uses = {key: 0 for key in self.runs}
+        self.uses_lock = threading.Lock()
+        self.usage = {}
+
+    def parent(self, key):
+        """Find the longest shared prefix that is a proper prefix of
+        `key`'s, or None.
+        """
+        prefix, *limits = key
+        for k in range(len(prefix) - 1, 0, -1):
+            parent = (prefix[:k], *limits)
+            if parent in self.runs:
+                return parent
+        return None
+
+    def output(self, name, cmds, in_data, timeout, uses=1, cpu=None):
+        """Get the output of a run's shared prefix.
+
+        `cmds` are the run's formatted commands and `uses` the number of
+        times the run's pipeline executes. If the prefix needs to be
+        computed, it is pinned to `cpu`. Return the number of stages in
+        the prefix, its output, and the wall-clock time it took. A run
+        without a shared prefix gets `(0, in_data, 0.0)`. Raise
+        `TimeoutExpired` if the prefix timed out.
+        """
+        key = self.keys.get(name)
+        if not key:
+            return 0, in_data, 0.0
+        with self.uses_lock:
+            self._count(key, uses)
+        return self._get(key, cmds, in_data, timeout, cpu)
+
+    def _count(self, key, uses):
+        # Without sharing, each use would run the prefix's parents too.
+        while key:
+            self.uses[key] += uses
+            key = self.parent(key)
+
+    def _get(self, key, cmds, in_data, timeout, cpu):
+        with self.locks[key]:
+            if key not in self.results:
+                self.results[key] = self._compute(key, cmds, in_data,
+                                                  timeout, cpu)
+        result = self.results[key]
+        if isinstance(result, Exception):
+            raise subprocess.TimeoutExpired(cmds[:len(key[0])], timeout)
+        return result
+
+    def _compute(self, key, cmds, in_data, timeout, cpu):
+        start_at, data, seconds = 0, in_data, 0.0
+        parent = self.parent(key)
+        if parent:
+            try:
+                start_at, data, seconds = self._get(parent, cmds, in_data,
+                                                    timeout, cpu)
+            except subprocess.TimeoutExpired as exc:
+                return exc
+        stages = []
+        start = time.perf_counter()
+        try:
+            data, _ = run_pipeline(cmds[start_at:len(key[0])], data,
+                                   max(timeout - seconds, 0), stages,
+                                   *key[1:], cpu)
+        except subprocess.TimeoutExpired as exc:
+            return exc
+        return self._computed(key, start_at, data, seconds, stages,
+                              time.perf_counter() - start)
+
+    def _computed(self, key, start_at, data, seconds, stages, elapsed):
+        for idx, stage in enumerate(stages, start_at):
+            stage['stage'] = idx
+        self.usage[key] = (stages, elapsed)
+        return len(key[0]), data, seconds + elapsed
+
+    def saved(self):
+        """Count the stage executions, and the seconds of CPU time they
+        would have taken, that sharing avoided.
+
+        Wall-clock time would overstate the savings, since it includes
+        waiting for the CPU while other jobs run.
+        """
+        count = 0
+        seconds = 0.0
+        for key, (stages, _) in self.usage.items():
+            cpu_time = sum((stage['user'] or 0.0) + (stage['sys'] or 0.0)
+                           for stage in stages)
+            count += (self.uses[key] - 1) * len(stages)
+            seconds += (self.uses[key] - 1) * cpu_time
+        return count, seconds
+
+    def stage_records(self):
+        """Generate resource usage records for the shared stages."""
+        bench, _ = os.path.splitext(os.path.basename(self.fn))
+        for key, (stages, _) in self.usage.items():
+            for stage in stages:
+                yield dict(
+                    stage, benchmark=bench, run=None,
+                    shared_by=self.runs[key], repetition=None,
+                    **{'pass': key[0][stage['stage']]},
+                )
+
+
+class AsyncSharedPrefixes(SharedPrefixes):
+    """`SharedPrefixes` for pipelines that run on an event loop."""
+    def __init__(self, fn, runs):
+        super().__init__(fn, runs)
+        # Create the locks on the loop, when they're first needed.
+        self.locks = {}
+
+    async def output(self, name, cmds, in_data, timeout, uses=1, cpu=None):
+        key = self.keys.get(name)
+        if not key:
+            return 0, in_data, 0.0
+        self._count(key, uses)
+        return await self._get(key, cmds, in_data, timeout, cpu)
+
+    async def _get(self, key, cmds, in_data, timeout, cpu):
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key not in self.results:
+                self.results[key] = await self._compute(key, cmds, in_data,
+                                                        timeout, cpu)
+        result = self.results[key]
+        if isinstance(result, Exception):
+            raise subprocess.TimeoutExpired(cmds[:len(key[0])], timeout)
+        return result
+
+    async def _compute(self, key, cmds, in_data, timeout, cpu):
+        start_at, data, seconds = 0, in_data, 0.0
+        parent = self.parent(key)
+        if parent:
+            try:
+                start_at, data, seconds = await self._get(
+                    parent, cmds, in_data, timeout, cpu,
+                )
+            except subprocess.TimeoutExpired as exc:
+                return exc
+        stages = []
+        start = time.perf_counter()
+        try:
+            data, _ = await run_pipeline_async(
+                cmds[start_at:len(key[0])], data, max(timeout - seconds, 0),
+                stages, *key[1:], cpu,
+            )
+        except subprocess.TimeoutExpired as exc:
+            return exc
+        return self._computed(key, start_at, data, seconds, stages,
+                              time.perf_counter() - start)
+
+
+def load_bench(pipeline, fn, timeout, warmup, repetitions, cache, tools,
+               memory_limit, cpu_limit, extract_re, keep_tokens):
+    """Load a benchmark and format its pipeline's commands.
+
+    Return the commands, the benchmark's contents, the cache key (or
+    None without a cache), and the cached samples (or None).
     """
     # Load the benchmark.
     with open(fn) as f:
@@ -66,12 +1061,292 @@ def run_bench(pipeline, fn, timeout):
     match = re.search(ARGS_RE, in_data)
     args = match.group(1) if match else ''
 
-    # Run pipeline.
     cmds = [
         c.format(args=args)
         for c in pipeline
     ]
-    return run_pipe(cmds, in_data, timeout)
+    if not cache:
+        return cmds, in_data, None, None
+
+    key = cache.key(CACHE_VERSION, in_data, cmds, args, warmup,
+                    repetitions, timeout, tools, memory_limit, cpu_limit,
+                    extract_re, keep_tokens)
+    entry = cache.get(key)
+    if not entry:
+        return cmds, in_data, key, None
+    samples = [Sample(*sample) for sample in entry['samples']]
+    return cmds, in_data, key, samples
+
+
+def run_bench(pipeline, fn, timeout, warmup=0, repetitions=1, cache=None,
+              tools=(), memory_limit=None, cpu_limit=None, prefixes=None,
+              name=None, cores=None, extract_re=None, keep_tokens=False):
+    """Run a single benchmark pipeline.
+
+    Run the pipeline `warmup` times, discarding the results, and then
+    `repetitions` times. Return a list of `Sample`s, one for each
+    measured repetition.
+
+    If a `ResultCache` is given, reuse its results for the same
+    benchmark contents, commands, settings, and `tools` hashes. Timeouts
+    aren't cached, since they may come from a busy machine.
+
+    The pipeline's shell commands are subject to `memory_limit` (in
+    bytes) and `cpu_limit` (in seconds).
+
+    With `SharedPrefixes`, only the stages after the prefix that run
+    `name` shares with other runs are executed for each repetition.
+
+    With a `CorePool`, the whole job is pinned to one of its CPUs.
+
+    Each sample's stdout is summarized as an `OutputDigest` with the
+    given `extract_re` and `keep_tokens`.
+    """
+    cmds, in_data, key, samples = load_bench(
+        pipeline, fn, timeout, warmup, repetitions, cache, tools,
+        memory_limit, cpu_limit, extract_re, keep_tokens,
+    )
+    if samples is not None:
+        return samples
+
+    cpu = cores.acquire() if cores else None
+    try:
+        start_at, data, prefix_time = 0, in_data, 0.0
+        if prefixes:
+            start_at, data, prefix_time = prefixes.output(
+                name, cmds, in_data, timeout, warmup + repetitions, cpu,
+            )
+        rest = cmds[start_at:]
+        rest_timeout = max(timeout - prefix_time, 0)
+
+        for _ in range(warmup):
+            run_pipeline(rest, data, rest_timeout, None, memory_limit,
+                         cpu_limit, cpu)
+        samples = []
+        for _ in range(repetitions):
+            stages = []
+            digest = OutputDigest(extract_re, keep_tokens)
+            start = time.perf_counter()
+            _, stderr = run_pipeline(rest, data, rest_timeout, stages,
+                                     memory_limit, cpu_limit, cpu, digest)
+            samples.append(_sample(digest, stderr, start, stages, start_at,
+                                   cpu))
+    finally:
+        if cores:
+            cores.release(cpu)
+
+    if cache:
+        cache.put(key, {'status': None, 'samples': samples})
+    return samples
+
+
+async def run_bench_async(pipeline, fn, timeout, warmup=0, repetitions=1,
+                          cache=None, tools=(), memory_limit=None,
+                          cpu_limit=None, prefixes=None, name=None,
+                          cores=None, extract_re=None, keep_tokens=False):
+    """Run a single benchmark pipeline like `run_bench`, on the running
+    event loop. `prefixes` must be `AsyncSharedPrefixes`.
+    """
+    cmds, in_data, key, samples = load_bench(
+        pipeline, fn, timeout, warmup, repetitions, cache, tools,
+        memory_limit, cpu_limit, extract_re, keep_tokens,
+    )
+    if samples is not None:
+        return samples
+
+    cpu = cores.acquire() if cores else None
+    try:
+        start_at, data, prefix_time = 0, in_data, 0.0
+        if prefixes:
+            start_at, data, prefix_time = await prefixes.output(
+                name, cmds, in_data, timeout, warmup + repetitions, cpu,
+            )
+        rest = cmds[start_at:]
+        rest_timeout = max(timeout - prefix_time, 0)
+
+        for _ in range(warmup):
+            await run_pipeline_async(rest, data, rest_timeout, None,
+                                     memory_limit, cpu_limit, cpu)
+        samples = []
+        for _ in range(repetitions):
+            stages = []
+            digest = OutputDigest(extract_re, keep_tokens)
+            start = time.perf_counter()
+            _, stderr = await run_pipeline_async(
+                rest, data, rest_timeout, stages, memory_limit, cpu_limit,
+                cpu, digest,
+            )
+            samples.append(_sample(digest, stderr, start, stages, start_at,
+                                   cpu))
+    finally:
+        if cores:
+            cores.release(cpu)
+
+    if cache:
+        cache.put(key, {'status': None, 'samples': samples})
+    return samples
+
+
+def _sample(digest, stderr, start, stages, start_at, cpu):
+    """Make a `Sample` for a pipeline execution that began at `start`,
+    numbering its stages from `start_at`.
+    """
+    elapsed = time.perf_counter() - start
+    for idx, stage in enumerate(stages, start_at):
+        stage['stage'] = idx
+    return Sample(digest.result(), stderr, elapsed, stages, cpu)
+
+
+class AsyncioExecutor(futures.Executor):
+    """Run coroutine functions as tasks on an event loop in a background
+    thread, at most `max_workers` at a time.
+
+    Waiting jobs cost no threads, and their coroutines aren't created
+    until they start. Cancelling a job's future cancels its task, which
+    kills the job's processes.
+    """
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.pending = deque()  # Waiting `(future, fn, args, kwargs)`.
+        self.tasks = set()  # Running jobs. Only used on the loop.
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _start_jobs(self):
+        while len(self.tasks) < self.max_workers and self.pending:
+            fut, fn, args, kwargs = self.pending.popleft()
+            if fut.cancelled():
+                continue
+            task = self.loop.create_task(fn(*args, **kwargs))
+            self.tasks.add(task)
+            task.add_done_callback(functools.partial(self._finish, fut))
+            fut.add_done_callback(functools.partial(self._cancel, task))
+
+    def _cancel(self, task, fut):
+        if fut.cancelled():
+            self.loop.call_soon_threadsafe(task.cancel)
+
+    def _finish(self, fut, task):
+        self.tasks.discard(task)
+        try:
+            if task.cancelled():
+                fut.cancel()
+            elif task.exception() is not None:
+                fut.set_exception(task.exception())
+            else:
+                fut.set_result(task.result())
+        except futures.InvalidStateError:
+            pass  # The future was cancelled first.
+        self._start_jobs()
+
+    def submit(self, fn, *args, **kwargs):
+        fut = futures.Future()
+        self.pending.append((fut, fn, args, kwargs))
+        self.loop.call_soon_threadsafe(self._start_jobs)
+        return fut
+
+    def _cancel_all(self):
+        while self.pending:
+            fut, *_ = self.pending.popleft()
+            fut.cancel()
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+
+    async def _wait_all(self):
+        # Finishing jobs start waiting ones, so wait until none are left.
+        while True:
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            if not tasks and not self.pending:
+                return
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.sleep(0)  # Let the waiting jobs start.
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        """Stop the event loop after its jobs finish (or, with
+        `cancel_futures`, after cancelling them). Running jobs always
+        finish, regardless of `wait`.
+        """
+        if self.loop.is_closed():
+            return
+        if cancel_futures:
+            self.loop.call_soon_threadsafe(self._cancel_all)
+        self._call(self._wait_all())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def physical_cores():
+    """List one CPU for each physical core that this process may use.
+
+    Hyperthreads share a core, so they would disturb each other's
+    timings. Without topology information (outside Linux's sysfs), every
+    usable CPU counts as a core.
+    """
+    cores = {}
+    for cpu in sorted(os.sched_getaffinity(0)):
+        topology = '/sys/devices/system/cpu/cpu{}/topology/'.format(cpu)
+        try:
+            with open(topology + 'physical_package_id') as f:
+                package = f.read().strip()
+            with open(topology + 'core_id') as f:
+                core = f.read().strip()
+        except OSError:
+            package, core = None, cpu
+        cores.setdefault((package, core), cpu)
+    return sorted(cores.values())
+
+
+class CorePool:
+    """Hand out CPUs so that concurrent jobs each get their own.
+
+    There must be at least as many CPUs as concurrent jobs.
+    """
+    def __init__(self, cpus):
+        self.free = list(reversed(cpus))
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            return self.free.pop()
+
+    def release(self, cpu):
+        with self.lock:
+            self.free.append(cpu)
+
+
+def submit_serially(pool, jobs, after):
+    """Submit jobs to run one at a time once the `after` futures finish.
+
+    `jobs` is a list of functions. Return a future for each job right
+    away, and run them in a background thread.
+    """
+    futs = [futures.Future() for _ in jobs]
+
+    def run():
+        futures.wait(after)
+        for fut, job in zip(futs, jobs):
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(pool.submit(job).result())
+            except BaseException as exc:
+                fut.set_exception(exc)
+
+    threading.Thread(target=run, daemon=True).start()
+    return futs
+
+
+EXECUTORS = {
+    'threads': (futures.ThreadPoolExecutor, run_bench, SharedPrefixes),
+    'asyncio': (AsyncioExecutor, run_bench_async, AsyncSharedPrefixes),
+}
 
 
 def get_result(strings, extract_re):
@@ -84,64 +1359,910 @@ def get_result(strings, extract_re):
     return None
 
 
-@click.command()
-@click.option('-j', '--jobs', default=None, type=int,
-              help='parallel threads to use (default: suitable for machine)')
-@click.argument('config_path', metavar='CONFIG', type=click.Path(exists=True))
-@click.argument('files', nargs=-1, type=click.Path(exists=True))
-def brench(config_path, files, jobs):
-    """Run a batch of benchmarks and emit a CSV of results.
+def bootstrap_ci(values, confidence=0.95, resamples=1000):
+    """Compute a bootstrap confidence interval for the mean of `values`.
+
+    Uses a fixed random seed so reports are reproducible.
+    """
+    rng = random.Random(0)
+    means = sorted(
+        statistics.fmean(rng.choices(values, k=len(values)))
+        for _ in range(resamples)
+    )
+    tail = (1 - confidence) / 2
+    return (means[int(tail * (resamples - 1))],
+            means[int((1 - tail) * (resamples - 1))])
+
+
+def sample_stats(values):
+    """Summarize a list of numeric samples as a dict of `STATS_COLUMNS`.
+    """
+    ci_low, ci_high = bootstrap_ci(values)
+    return {
+        'mean': statistics.fmean(values),
+        'median': statistics.median(values),
+        'stddev': statistics.stdev(values) if len(values) > 1 else 0.0,
+        'min': min(values),
+        'ci_low': ci_low,
+        'ci_high': ci_high,
+    }
+
+
+def stage_totals(records):
+    """Aggregate per-stage resource usage records by pass.
+
+    Sum the times and take the maximum peak RSS for each distinct
+    pipeline stage (before `{args}` substitution) across all benchmarks.
+    """
+    totals = {}
+    for rec in records:
+        tot = totals.setdefault(rec['pass'], {
+            'count': 0, 'wall': 0.0, 'user': 0.0, 'sys': 0.0,
+            'maxrss_kb': None,
+        })
+        tot['count'] += 1
+        for key in ('wall', 'user', 'sys'):
+            tot[key] += rec[key] or 0.0
+        if rec['maxrss_kb'] is not None:
+            tot['maxrss_kb'] = max(tot['maxrss_kb'] or 0, rec['maxrss_kb'])
+    return totals
+
+
+def get_setting(config, run, key, default):
+    """Look up a setting for a run, falling back to the global config.
+    """
+    return run.get(key, config.get(key, default))
+
+
+def limit_status(samples, cpu_limit):
+    """Check whether any stage was stopped by a resource limit.
+
+    Return `'timeout'` if a stage exceeded its `cpu_limit` or `'oom'` if
+    a stage ran out of memory (see `stage_usage`). Otherwise, return
+    None.
+    """
+    for sample in samples:
+        for stage in sample.stages:
+            exit = stage.get('exit')
+            # A shell reports a child killed by a signal as 128 + signal.
+            if cpu_limit and exit in (-signal.SIGXCPU, 128 + signal.SIGXCPU):
+                return 'timeout'
+            if stage.get('oom'):
+                return 'oom'
+    return None
+
+
+def memory_limit_bytes(config, run):
+    """Get a run's memory limit (configured in megabytes) in bytes."""
+    limit = get_setting(config, run, 'memory_limit', None)
+    return int(limit * 1024 * 1024) if limit else None
+
+
+def judge_benchmark(fn, results, config, with_stats):
+    """Check and summarize all the runs of one benchmark.
+
+    `results` maps each run name to its list of `Sample`s, or to None if
+    it timed out. Return a list of row dicts, one per run in config
+    order. Each has the `benchmark` and `run` names, a `status` (None if
+    the run succeeded), the `result` value, the `values` and `samples`
+    for each repetition, and a `stats` dict (empty unless `with_stats`).
+    For incorrect output, `first_diff` is the index of the first token
+    that differs from the first run's output (see `compare_digests`).
+    """
+    ε = config.get('epsilon', 0.0)
+
+    # The figure of merit is either extracted from the output or, with
+    # `metric = "wall"`, the pipeline's wall-clock time in seconds.
+    metric = config.get('metric', 'extract')
+
+    bench, _ = os.path.splitext(os.path.basename(fn))
+    rows = []
+    first_out = None
+    for i, name in enumerate(config['runs']):
+        samples = results[name]
+        if samples is None:
+            samples = [Sample(OutputDigest().result(), '', None, [])]
+            status = 'timeout'
+        else:
+            status = limit_status(samples, get_setting(
+                config, config['runs'][name], 'cpu_limit', None,
+            ))
+
+        # Check correctness of every repetition against the first run,
+        # unless that timed out.
+        outs = [sample.stdout for sample in samples]
+        if i == 0 and not status:
+            first_out = outs[0]
+        first_diff = None
+        if first_out and not status:
+            diffs = [compare_digests(first_out, out, ε) for out in outs]
+            first_diff = min((d for d in diffs if d is not None),
+                             default=None)
+            if first_diff is not None:
+                status = 'incorrect'
+
+        # Extract the figure of merit.
+        if metric == 'wall':
+            values = [sample.seconds for sample in samples]
+        else:
+            values = [sample.stdout['match'] or
+                      get_result([sample.stderr], config['extract'])
+                      for sample in samples]
+        if not all(values) and not status:
+            status = 'missing'
+
+        # Summarize repeated samples.
+        stats = {}
+        if with_stats and not status:
+            try:
+                stats = sample_stats([float(v) for v in values])
+            except ValueError:
+                status = 'missing'
+
+        # A single repetition's value is reported as it was extracted.
+        # Medians of whole numbers, like instruction counts, stay whole.
+        result = values[0]
+        if stats and len(values) > 1:
+            result = stats['median']
+            if metric != 'wall' and result.is_integer():
+                result = int(result)
+
+        rows.append({
+            'benchmark': bench,
+            'run': name,
+            'status': status,
+            'result': result,
+            'values': values,
+            'samples': samples,
+            'stats': stats,
+            'first_diff': first_diff,
+        })
+    return rows
+
+
+def stage_records(row, pipeline):
+    """Generate per-stage resource usage records for a result row."""
+    for rep, sample in enumerate(row['samples']):
+        for stage in sample.stages:
+            yield dict(
+                stage, benchmark=row['benchmark'], run=row['run'],
+                repetition=rep, cpu=sample.cpu,
+                **{'pass': pipeline[stage['stage']]},
+            )
+
+
+class CSVOutput:
+    """Write result rows as CSV."""
+    def __init__(self, out, with_stats):
+        self.out = out
+        self.with_stats = with_stats
+        self.writer = csv.writer(out)
+        self.writer.writerow(['benchmark', 'run', 'result'] +
+                             (STATS_COLUMNS if with_stats else []))
+
+    def write(self, row):
+        fields = [
+            row['benchmark'],
+            row['run'],
+            row['status'] if row['status'] else row['result'],
+        ]
+        if self.with_stats:
+            fields += [row['stats'].get(c, '') for c in STATS_COLUMNS]
+        self.writer.writerow(fields)
+
+
+class JSONLOutput:
+    """Write result rows as JSON Lines, one object per row."""
+    def __init__(self, out, with_stats):
+        self.out = out
+
+    def write(self, row):
+        obj = {
+            'benchmark': row['benchmark'],
+            'run': row['run'],
+            'status': row['status'] or 'ok',
+            # Always numbers, however many repetitions there were.
+            'result': None if row['status'] else _number(row['result']),
+            'values': [_number(v) for v in row['values']],
+            'seconds': [sample.seconds for sample in row['samples']],
+            'cpu': row['samples'][0].cpu,
+        }
+        if row['first_diff'] is not None:
+            obj['first_diff'] = row['first_diff']
+        obj.update(row['stats'])
+        self.out.write(json.dumps(obj) + '\n')
+
+
+OUTPUT_FORMATS = {
+    'csv': CSVOutput,
+    'jsonl': JSONLOutput,
+}
+
+
+def finished_benchmarks(files, runs, futs, stream):
+    """Wait for benchmarks to finish and generate `(fn, results)` pairs,
+    where `results` maps run names to lists of samples (or None for a
+    timeout).
+
+    Benchmarks come in file order or, with `stream`, as soon as all of
+    their runs have finished.
+    """
+    def result(fut):
+        try:
+            return fut.result()
+        except subprocess.TimeoutExpired:
+            return None
+
+    if not stream:
+        for fn in files:
+            yield fn, {name: result(futs[(fn, name)]) for name in runs}
+        return
+
+    keys = {fut: key for key, fut in futs.items()}
+    pending = {fn: len(runs) for fn in files}
+    for fut in futures.as_completed(keys):
+        fn, _ = keys[fut]
+        pending[fn] -= 1
+        if not pending[fn]:
+            yield fn, {name: result(futs[(fn, name)]) for name in runs}
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_results(path):
+    """Load a CSV or JSON Lines file of brench results.
+
+    Return a dict mapping `(benchmark, run)` to a dict with the `text`
+    of the result, its numeric `result` (or None for a status), the
+    numeric per-repetition `values` (only in JSON Lines), and the
+    confidence interval `ci` (or None).
+    """
+    rows = {}
+    with open(path, newline='') as f:
+        jsonl = f.read(1) == '{'
+        f.seek(0)
+        if jsonl:
+            records = (json.loads(line) for line in f if line.strip())
+        else:
+            records = csv.DictReader(f)
+        for rec in records:
+            if jsonl:
+                result = rec['result']
+                if isinstance(result, float) and result.is_integer():
+                    result = int(result)
+                text = rec['status'] if rec['status'] != 'ok' \
+                    else str(result)
+                values = [_number(v) for v in rec.get('values') or []]
+                if None in values:
+                    values = None
+            else:
+                text = rec['result']
+                values = None
+            ci = (_number(rec.get('ci_low')), _number(rec.get('ci_high')))
+            rows[(rec['benchmark'], rec['run'])] = {
+                'text': text,
+                'result': _number(text),
+                'values': values or None,
+                'ci': None if None in ci else ci,
+            }
+    return rows
+
+
+def permutation_test(old, new, resamples=1000):
+    """Estimate the two-sided p-value of the difference between the means
+    of two samples by randomly relabeling them.
+
+    Uses a fixed random seed so reports are reproducible.
+    """
+    observed = abs(statistics.fmean(new) - statistics.fmean(old))
+    if len(set(old)) == 1 and len(set(new)) == 1:
+        # Deterministic measurements, like instruction counts.
+        return 0.0 if observed else 1.0
+
+    rng = random.Random(0)
+    pooled = old + new
+    hits = 0
+    for _ in range(resamples):
+        rng.shuffle(pooled)
+        diff = abs(statistics.fmean(pooled[len(old):]) -
+                   statistics.fmean(pooled[:len(old)]))
+        if diff >= observed:
+            hits += 1
+    return (hits + 1) / (resamples + 1)
+
+
+def compare_row(old, new, alpha):
+    """Compare the results of one benchmark and run.
+
+    Return the ratio of the new result to the old one (or None), the
+    p-value of the difference (or None), and a verdict: `better`,
+    `worse`, or `same` for numeric results (lower is better), or
+    `broken`, `fixed`, `failing`, `added`, or `removed`.
+    """
+    if old is None:
+        return None, None, 'added'
+    if new is None:
+        return None, None, 'removed'
+    if old['result'] is None:
+        return None, None, 'failing' if new['result'] is None else 'fixed'
+    if new['result'] is None:
+        return None, None, 'broken'
+
+    ratio = new['result'] / old['result'] if old['result'] else None
+    p = None
+    if new['result'] == old['result']:
+        significant = False
+    elif old['values'] and new['values'] and \
+            len(old['values']) > 1 and len(new['values']) > 1:
+        p = permutation_test(old['values'], new['values'])
+        significant = p < alpha
+    elif old['ci'] and new['ci']:
+        significant = old['ci'][1] < new['ci'][0] or \
+            new['ci'][1] < old['ci'][0]
+    else:
+        # A single measurement is all there is.
+        significant = True
+
+    if not significant:
+        return ratio, p, 'same'
+    return ratio, p, 'worse' if new['result'] > old['result'] else 'better'
+
+
+def parse_address(address):
+    """Parse a `HOST:PORT` TCP address into a pair. Any other address is
+    a Unix socket path.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host or 'localhost', int(port)
+    return address
+
+
+def _message(msg):
+    return json.dumps(msg).encode() + b'\n'
+
+
+class JobServer:
+    """Hand out benchmark jobs to `brench work` processes over a socket.
+
+    `jobs` maps each job's key to a JSON-friendly message describing it,
+    and its result (a list of `Sample`s) arrives in the future with the
+    same key in `futs`. Workers ask for a job whenever they can take one
+    and send a heartbeat every `HEARTBEAT_INTERVAL` seconds. When a
+    worker disconnects or is silent for `heartbeat_timeout` seconds, its
+    unfinished jobs go back in the queue.
+    """
+    def __init__(self, jobs, heartbeat_timeout):
+        self.jobs = jobs
+        self.keys = list(jobs)
+        self.futs = {key: futures.Future() for key in jobs}
+        self.pending = deque(range(len(self.keys)))
+        self.workers = {}
+        self.heartbeat_timeout = heartbeat_timeout
+
+    async def start(self, address):
+        """Listen on an address and return it, with the real port if it
+        was 0.
+        """
+        addr = parse_address(address)
+        self.path = None
+        if isinstance(addr, tuple):
+            self.server = await asyncio.start_server(self.handle, *addr,
+                                                     limit=MESSAGE_LIMIT)
+            host, port = self.server.sockets[0].getsockname()[:2]
+            address = '{}:{}'.format(host, port)
+        else:
+            self.server = await asyncio.start_unix_server(
+                self.handle, addr, limit=MESSAGE_LIMIT,
+            )
+            self.path = addr
+        self.monitor_task = asyncio.ensure_future(self.monitor())
+        return address
+
+    async def stop(self):
+        """Stop listening and dismiss all the workers."""
+        self.monitor_task.cancel()
+        self.server.close()
+        for writer in list(self.workers):
+            writer.write(_message({'type': 'done'}))
+            writer.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def handle(self, reader, writer):
+        worker = self.workers[writer] = {
+            'credit': 0, 'jobs': set(), 'seen': time.monotonic(),
+        }
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line)
+                worker['seen'] = time.monotonic()
+                if msg['type'] == 'ready':
+                    worker['credit'] += 1
+                elif msg['type'] == 'result':
+                    self.finish(worker, msg)
+                self.dispatch()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            del self.workers[writer]
+            writer.close()
+
+            # Give this worker's unfinished jobs to someone else.
+            self.pending.extendleft(sorted(worker['jobs'], reverse=True))
+            self.dispatch()
+
+    def dispatch(self):
+        for writer, worker in self.workers.items():
+            while worker['credit'] and self.pending:
+                job = self.pending.popleft()
+                key = self.keys[job]
+                if self.futs[key].done():
+                    continue
+                worker['credit'] -= 1
+                worker['jobs'].add(job)
+                writer.write(_message(dict(self.jobs[key], type='job',
+                                           id=job)))
+
+    def finish(self, worker, msg):
+        worker['jobs'].discard(msg['id'])
+        fut = self.futs[self.keys[msg['id']]]
+        if fut.done():
+            return  # Another worker got there first.
+        if msg['status'] == 'timeout':
+            settings = self.jobs[self.keys[msg['id']]]['settings']
+            fut.set_exception(subprocess.TimeoutExpired(
+                settings['pipeline'], settings['timeout'],
+            ))
+        elif msg['status'] == 'error':
+            fut.set_exception(RuntimeError(msg['error']))
+        else:
+            fut.set_result([Sample(*sample) for sample in msg['samples']])
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            for writer, worker in list(self.workers.items()):
+                if now - worker['seen'] > self.heartbeat_timeout:
+                    # This ends the worker's `handle` coroutine.
+                    writer.transport.abort()
+
+
+def run_job(job, tmpdir):
+    """Run a job from a `brench serve` coordinator and return the result
+    message.
     """
+    # The benchmark file may not exist on this machine, so write out the
+    # copy that came with the job.
+    dirname = os.path.join(tmpdir, str(job['id']))
+    os.makedirs(dirname, exist_ok=True)
+    path = os.path.join(dirname, job['name'])
+    with open(path, 'w') as f:
+        f.write(job['source'])
+
+    result = {'type': 'result', 'id': job['id']}
+    try:
+        result['samples'] = run_bench(fn=path, **job['settings'])
+        result['status'] = 'ok'
+    except subprocess.TimeoutExpired:
+        result['status'] = 'timeout'
+    except Exception:
+        result['status'] = 'error'
+        result['error'] = traceback.format_exc()
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+    return result
+
+
+def load_config(config_path, files):
+    """Load a configuration file and find the benchmark files."""
     with open(config_path) as f:
         config = tomlkit.loads(f.read())
 
     # Use configured file list, if none is specified via the CLI.
     if not files and 'benchmarks' in config:
         files = glob.glob(config['benchmarks'])
+    return config, files
 
-    timeout = config.get('timeout', 5)
-    ε = config.get('epsilon', 0.0)
 
-    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
-        # Submit jobs.
-        futs = {}
-        for fn in files:
-            for name, run in config['runs'].items():
-                futs[(fn, name)] = pool.submit(run_bench, run['pipeline'], fn,
-                                               timeout)
+def bench_settings(config):
+    """Get the `run_bench` arguments for each run that come from the
+    configuration, as JSON-friendly dicts.
+    """
+    metric = config.get('metric', 'extract')
+    settings = {}
+    for name, run in config['runs'].items():
+        limited = get_setting(config, run, 'memory_limit', None) or \
+            get_setting(config, run, 'cpu_limit', None)
+        if limited and not hasattr(resource, 'prlimit'):
+            raise click.UsageError('resource limits are not supported on '
+                                   'this platform')
+        settings[name] = {
+            'pipeline': [str(cmd) for cmd in run['pipeline']],
+            'timeout': config.get('timeout', 5),
+            'warmup': get_setting(config, run, 'warmup', 0),
+            'repetitions': get_setting(config, run, 'repetitions', 1),
+            'memory_limit': memory_limit_bytes(config, run),
+            'cpu_limit': get_setting(config, run, 'cpu_limit', None),
+            'extract_re': config.get('extract')
+            if metric == 'extract' else None,
+            # Outputs are only compared token by token with an ε.
+            'keep_tokens': bool(config.get('epsilon', 0.0)),
+        }
 
-        # Collect results and print CSV.
-        writer = csv.writer(sys.stdout)
-        writer.writerow(['benchmark', 'run', 'result'])
-        for fn in files:
-            first_out = None
-            for name in config['runs']:
-                try:
-                    stdout, stderr = futs[(fn, name)].result()
-                except subprocess.TimeoutExpired:
-                    stdout, stderr = '', ''
-                    status = 'timeout'
-                else:
-                    status = None
-
-                # Check correctness.
-                if first_out is None:
-                    first_out = stdout
-                elif not compare_output(stdout, first_out, ε) and not status:
-                    status = 'incorrect'
-
-                # Extract the figure of merit.
-                result = get_result([stdout, stderr], config['extract'])
-                if not result and not status:
-                    status = 'missing'
-
-                # Report the result.
-                bench, _ = os.path.splitext(os.path.basename(fn))
-                writer.writerow([
-                    bench,
-                    name,
-                    status if status else result,
-                ])
+    # In-process stages can't be interrupted, so the timeout only takes
+    # effect after they return.
+    if 'timeout' in config and any(
+        cmd.startswith(PYTHON_STAGE)
+        for s in settings.values() for cmd in s['pipeline']
+    ):
+        print('warning: timeout does not interrupt in-process stages',
+              file=sys.stderr)
+    return settings
+
+
+def open_cache(config, no_cache, cache_dir, cache_size):
+    """Get the result cache and tool hashes for the command-line options.
+    """
+    if no_cache:
+        return None, ()
+    cache = ResultCache(cache_dir, int(cache_size * 1024 * 1024))
+    return cache, tool_hashes(config)
+
+
+def report(config, files, futs, with_stats, fmt, stream, stage_stats,
+           cache=None, shared=()):
+    """Judge and print the results of each benchmark as its jobs finish,
+    and then summarize the cache, shared prefixes, and stage stats.
+    """
+    records = []
+    output = OUTPUT_FORMATS[fmt](sys.stdout, with_stats)
+    for fn, results in finished_benchmarks(files, config['runs'], futs,
+                                           stream):
+        for row in judge_benchmark(fn, results, config, with_stats):
+            records += stage_records(
+                row, config['runs'][row['run']]['pipeline'],
+            )
+            output.write(row)
+        if stream:
+            sys.stdout.flush()
+
+    if cache:
+        cache.evict()
+        print('cache: {} hits, {} misses'.format(cache.hits, cache.misses),
+              file=sys.stderr)
+
+    saved = [prefixes.saved() for prefixes in shared]
+    if any(count for count, _ in saved):
+        print('shared prefixes: saved {} stage runs ({:.2f} s of CPU time)'
+              .format(sum(count for count, _ in saved),
+                      sum(seconds for _, seconds in saved)),
+              file=sys.stderr)
+    for prefixes in shared:
+        records += prefixes.stage_records()
+
+    if stage_stats:
+        json.dump({
+            'stages': records,
+            'totals': stage_totals(records),
+        }, stage_stats, indent=2)
+
+
+def report_options(func):
+    """Add the options for caching and reporting results to a command."""
+    options = [
+        click.option('--no-cache', is_flag=True,
+                     help='run everything, ignoring cached results'),
+        click.option('--cache-dir', default=default_cache_dir,
+                     type=click.Path(file_okay=False),
+                     help='directory for cached results'),
+        click.option('--cache-size', default=256, type=float,
+                     show_default=True,
+                     help='maximum cache size in megabytes'),
+        click.option('--stage-stats', type=click.File('w'), default=None,
+                     help='write per-stage resource usage to this JSON '
+                          'file'),
+        click.option('--stream', is_flag=True,
+                     help='emit each benchmark as soon as it finishes'),
+        click.option('--format', 'fmt', default='csv', show_default=True,
+                     type=click.Choice(sorted(OUTPUT_FORMATS)),
+                     help='output format'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+class DefaultGroup(click.Group):
+    """A command group that runs benchmarks when the first argument
+    isn't a command, so `brench CONFIG FILES...` still works.
+    """
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and \
+                args[0] not in ctx.help_option_names:
+            args = ['run'] + args
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup)
+def brench():
+    """Run a batch of benchmarks and emit a CSV of results.
+
+    With no command, brench runs the benchmarks locally (see `run`).
+    """
+
+
+@brench.command()
+@click.option('-j', '--jobs', default=None, type=int,
+              help='parallel threads to use (default: suitable for machine)')
+@report_options
+@click.option('--no-share', is_flag=True,
+              help='run every pipeline in full, without sharing prefixes')
+@click.option('--executor', default='threads', show_default=True,
+              type=click.Choice(sorted(EXECUTORS)),
+              help='how to run pipelines concurrently')
+@click.option('--pin', is_flag=True,
+              help='pin each job to its own physical core')
+@click.argument('config_path', metavar='CONFIG', type=click.Path(exists=True))
+@click.argument('files', nargs=-1, type=click.Path(exists=True))
+def run(config_path, files, jobs, no_cache, cache_dir, cache_size,
+        stage_stats, stream, fmt, no_share, executor, pin):
+    """Run a batch of benchmarks and emit a CSV of results.
+    """
+    config, files = load_config(config_path, files)
+    settings = bench_settings(config)
+    with_stats = any(s['repetitions'] > 1 for s in settings.values())
+    cache, tools = open_cache(config, no_cache, cache_dir, cache_size)
+
+    limits = {
+        name: (s['pipeline'], s['memory_limit'], s['cpu_limit'])
+        for name, s in settings.items()
+    }
+
+    # Sharing prefixes would leave out their time from wall-clock
+    # measurements.
+    share = not no_share and config.get('metric', 'extract') != 'wall'
+    shared = []
+
+    # Give each job a dedicated core, and don't run more jobs than that.
+    if pin:
+        if not hasattr(os, 'sched_setaffinity'):
+            raise click.UsageError('--pin is not supported on this platform')
+        cpus = physical_cores()
+        jobs = min(jobs or len(cpus), len(cpus))
+        cores = CorePool(cpus)
+    else:
+        cores = None
+
+    executor_cls, bench_func, prefixes_cls = EXECUTORS[executor]
+    with executor_cls(max_workers=jobs) as pool:
+        try:
+            # Submit jobs. Serial runs wait until the rest are done.
+            futs = {}
+            serial = []
+            for fn in files:
+                prefixes = prefixes_cls(fn, limits) if share else None
+                if prefixes:
+                    shared.append(prefixes)
+                for name, run in config['runs'].items():
+                    job = functools.partial(
+                        bench_func, fn=fn, cache=cache, tools=tools,
+                        prefixes=prefixes, name=name, cores=cores,
+                        **settings[name],
+                    )
+                    if get_setting(config, run, 'serial', False):
+                        serial.append(((fn, name), job))
+                    else:
+                        futs[(fn, name)] = pool.submit(job)
+            if serial:
+                serial_futs = submit_serially(
+                    pool, [job for _, job in serial], list(futs.values()),
+                )
+                for (key, _), fut in zip(serial, serial_futs):
+                    futs[key] = fut
+
+            report(config, files, futs, with_stats, fmt, stream,
+                   stage_stats, cache, shared)
+        except KeyboardInterrupt:
+            # Don't wait for the rest of the jobs.
+            for fut in futs.values():
+                fut.cancel()
+            pool.shutdown(cancel_futures=True)
+            raise
+
+
+@brench.command()
+@click.option('--listen', default='localhost:0', show_default=True,
+              metavar='ADDRESS',
+              help='HOST:PORT or Unix socket path to listen on '
+                   '(port 0 picks a free port)')
+@click.option('--heartbeat-timeout', default=10.0, show_default=True,
+              help='seconds of silence before a worker counts as dead')
+@report_options
+@click.argument('config_path', metavar='CONFIG', type=click.Path(exists=True))
+@click.argument('files', nargs=-1, type=click.Path(exists=True))
+def serve(config_path, files, listen, heartbeat_timeout, no_cache, cache_dir,
+          cache_size, stage_stats, stream, fmt):
+    """Hand out benchmarks to `brench work` processes and emit a CSV of
+    their results.
+    """
+    # Healthy workers are silent for up to a heartbeat interval.
+    if heartbeat_timeout <= HEARTBEAT_INTERVAL:
+        raise click.UsageError(
+            '--heartbeat-timeout must be more than the {} s between '
+            'heartbeats'.format(HEARTBEAT_INTERVAL)
+        )
+    config, files = load_config(config_path, files)
+    settings = bench_settings(config)
+    with_stats = any(s['repetitions'] > 1 for s in settings.values())
+    cache, tools = open_cache(config, no_cache, cache_dir, cache_size)
+
+    # Use cached results here, and send the rest to workers.
+    jobs = {}
+    keys = {}
+    futs = {}
+    for fn in files:
+        for name in config['runs']:
+            _, source, key, samples = load_bench(
+                fn=fn, cache=cache, tools=tools, **settings[name],
+            )
+            if samples is not None:
+                futs[(fn, name)] = futures.Future()
+                futs[(fn, name)].set_result(samples)
+                continue
+            jobs[(fn, name)] = {
+                'name': os.path.basename(fn),
+                'source': source,
+                'settings': settings[name],
+            }
+            keys[(fn, name)] = key
+
+    server = JobServer(jobs, heartbeat_timeout)
+    for job_key, fut in server.futs.items():
+        futs[job_key] = fut
+        if cache:
+            fut.add_done_callback(functools.partial(
+                _cache_result, cache, keys[job_key],
+            ))
+
+    with AsyncioExecutor(max_workers=1) as loop:
+        address = loop.submit(server.start, listen).result()
+        print('serving {} jobs on {}'.format(len(jobs), address),
+              file=sys.stderr, flush=True)
+        try:
+            report(config, files, futs, with_stats, fmt, stream,
+                   stage_stats, cache)
+        finally:
+            loop.submit(server.stop).result()
+
+
+def _cache_result(cache, key, fut):
+    if not fut.cancelled() and not fut.exception():
+        cache.put(key, {'status': None, 'samples': fut.result()})
+
+
+@brench.command()
+@click.option('-j', '--jobs', default=None, type=int,
+              help='benchmarks to run at once (default: number of CPUs)')
+@click.argument('address')
+def work(address, jobs):
+    """Run benchmarks for the `brench serve` coordinator at ADDRESS.
+
+    Run this in a checkout laid out like the coordinator's, so that the
+    commands in the pipelines work the same way.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    addr = parse_address(address)
+    if isinstance(addr, tuple):
+        sock = socket.create_connection(addr)
+    else:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(addr)
+
+    lock = threading.Lock()
+
+    def send(msg):
+        with lock:
+            sock.sendall(_message(msg))
+
+    def heartbeat():
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                send({'type': 'heartbeat'})
+            except OSError:
+                return
+
+    def done(fut):
+        try:
+            send(fut.result())
+            send({'type': 'ready'})
+        except OSError:
+            pass  # The coordinator is gone.
+
+    stopped = threading.Event()
+    threading.Thread(target=heartbeat, daemon=True).start()
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        try:
+            for _ in range(jobs):
+                send({'type': 'ready'})
+            for line in sock.makefile('rb'):
+                msg = json.loads(line)
+                if msg['type'] == 'done':
+                    break
+                pool.submit(run_job, msg, tmpdir).add_done_callback(done)
+        finally:
+            stopped.set()
+            sock.close()
+
+
+@brench.command()
+@click.option('--alpha', default=0.05, show_default=True,
+              help='significance level for differences between samples')
+@click.option('--max-increase', type=float, default=None, metavar='PERCENT',
+              help='fail if any result significantly increases by more '
+                   'than this')
+@click.option('--max-geomean-increase', type=float, default=None,
+              metavar='PERCENT',
+              help="fail if any run's geometric mean ratio increases by "
+                   "more than this")
+@click.argument('old_path', metavar='OLD', type=click.Path(exists=True))
+@click.argument('new_path', metavar='NEW', type=click.Path(exists=True))
+def compare(old_path, new_path, alpha, max_increase, max_geomean_increase):
+    """Compare two sets of results and emit a CSV of the differences.
+
+    OLD and NEW are CSV or JSON Lines output from brench. Exit with
+    status 1 if a run that worked in OLD fails in NEW, or a result gets
+    worse by more than the given thresholds.
+    """
+    old = load_results(old_path)
+    new = load_results(new_path)
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['benchmark', 'run', 'old', 'new', 'ratio', 'p',
+                     'verdict'])
+    ratios = {}
+    regressions = []
+    for key in list(old) + [key for key in new if key not in old]:
+        ratio, p, verdict = compare_row(old.get(key), new.get(key), alpha)
+        writer.writerow([
+            key[0], key[1],
+            old[key]['text'] if key in old else '',
+            new[key]['text'] if key in new else '',
+            '' if ratio is None else '{:.4f}'.format(ratio),
+            '' if p is None else '{:.4f}'.format(p),
+            verdict,
+        ])
+        if ratio and ratio > 0:
+            ratios.setdefault(key[1], []).append(ratio)
+        if verdict == 'broken':
+            regressions.append('{} {}: {}'.format(*key, new[key]['text']))
+        elif verdict == 'worse' and max_increase is not None and \
+                ratio and ratio > 1 + max_increase / 100:
+            regressions.append('{} {}: {:.4f}x'.format(*key, ratio))
+
+    for run, run_ratios in ratios.items():
+        geomean = statistics.geometric_mean(run_ratios)
+        print('{}: geomean {:.4f}x over {} benchmarks'.format(
+            run, geomean, len(run_ratios),
+        ), file=sys.stderr)
+        if max_geomean_increase is not None and \
+                geomean > 1 + max_geomean_increase / 100:
+            regressions.append('{}: geomean {:.4f}x'.format(run, geomean))
+
+    for regression in regressions:
+        print('regression: {}'.format(regression), file=sys.stderr)
+    if regressions:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
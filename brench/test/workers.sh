@@ -0,0 +1,50 @@
+#!/bin/sh
+# Run a config with `brench serve` and two `brench work` processes on
+# localhost, sending SIGNAL to one of the workers partway through. Its
+# unfinished jobs should go to the other worker, so the CSV matches a
+# local run.
+#
+#     ./workers.sh SIGNAL CONFIG FILES...
+
+sig=$1
+shift
+log=$(mktemp)
+trap 'rm -f "$log"' EXIT
+
+python3 ../brench.py serve --no-cache --heartbeat-timeout 3 \
+    --listen 127.0.0.1:0 "$@" 2> "$log" &
+serve=$!
+
+# Wait for the coordinator to say where it is listening.
+addr=
+while [ -z "$addr" ]; do
+    kill -0 $serve 2> /dev/null || exit 1
+    sleep 0.1
+    addr=$(sed -n 's/^serving .* on //p' "$log")
+done
+
+python3 ../brench.py work -j 1 "$addr" 2> /dev/null &
+victim=$!
+python3 ../brench.py work -j 1 "$addr" 2> /dev/null &
+survivor=$!
+
+sleep 1
+kill -s "$sig" $victim
+
+# Fail instead of waiting forever if the other worker dies too. (It
+# also exits when the coordinator is done, just before the coordinator.)
+while kill -0 $serve 2> /dev/null; do
+    if ! kill -0 $survivor 2> /dev/null; then
+        sleep 2
+        kill $serve 2> /dev/null
+        break
+    fi
+    sleep 0.1
+done
+wait $serve
+status=$?
+
+# A stopped worker never finishes on its own.
+kill -s KILL $victim 2> /dev/null
+wait
+exit $status
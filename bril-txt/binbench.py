@@ -0,0 +1,67 @@
+"""Compare the binary Bril format to JSON in size and decoding speed.
+
+Parses each Bril text file given on the command line and reports the
+sizes of the indented JSON (as `bril2json` emits it), compact JSON, and
+the binary encoding, along with the time to decode each. For example:
+
+    $ python3 binbench.py ../benchmarks/*.bril
+"""
+
+import argparse
+import json
+import time
+
+import briltxt
+from parsebench import synth_program
+
+
+def timed(func, arg, reps):
+    start = time.perf_counter()
+    for _ in range(reps):
+        func(arg)
+    return (time.perf_counter() - start) / reps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*', help='Bril text files')
+    parser.add_argument('-p', action='store_true',
+                        help='include source positions')
+    parser.add_argument('--synth', type=float, default=4.0, metavar='MB',
+                        help='size of a synthetic program to add '
+                             '(default: 4 MB of text)')
+    parser.add_argument('-n', '--reps', type=int, default=3,
+                        help='decoding repetitions (default: 3)')
+    args = parser.parse_args()
+
+    sources = []
+    for fn in args.files:
+        with open(fn) as f:
+            sources.append(f.read())
+    if args.synth:
+        sources.append(synth_program(int(args.synth * 1024 * 1024)))
+
+    sizes = {'json': 0, 'compact': 0, 'bin': 0}
+    times = {'json': 0.0, 'compact': 0.0, 'bin': 0.0}
+    for txt in sources:
+        prog = briltxt.parse_data(txt, args.p)
+        encoded = {
+            'json': json.dumps(prog, indent=2, sort_keys=True),
+            'compact': json.dumps(prog, separators=(',', ':')),
+            'bin': briltxt.encode_bin(prog),
+        }
+        for name, data in encoded.items():
+            sizes[name] += len(data)
+            decode = briltxt.decode_bin if name == 'bin' else json.loads
+            times[name] += timed(decode, data, args.reps)
+
+    print('{:<8} {:>12} {:>7} {:>10}'.format('format', 'bytes', 'ratio',
+                                             'decode s'))
+    for name in sizes:
+        print('{:<8} {:>12} {:>7.2f} {:>10.3f}'.format(
+            name, sizes[name], sizes[name] / sizes['json'], times[name],
+        ))
+
+
+if __name__ == '__main__':
+    main()
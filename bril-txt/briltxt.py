@@ -10,6 +10,15 @@ format and emits the ordinary JSON representation.
 import lark
 import sys
 import json
+import argparse
+import functools
+import io
+import itertools
+import os
+import re
+import struct
+import time
+from concurrent import futures
 
 __version__ = '0.0.1'
 
@@ -22,7 +31,7 @@ start: (struct | func)*
 struct: STRUCT IDENT "=" "{" mbr* "}"
 mbr: IDENT ":" type ";"
 
-func: FUNC ["(" arg_list? ")"] [tyann] "{" instr* "}"
+func: FUNC ["(" arg_list ")"] [tyann] "{" instr* "}"
 arg_list: | arg ("," arg)*
 arg: IDENT ":" type
 ?instr: const | vop | eop | label
@@ -62,15 +71,16 @@ COMMENT: /#.*/
 """.strip()
 
 
-def _pos(token):
+def _pos(token, line_offset=0):
     """Generate a position dict from a Lark token."""
-    return {'row': token.line, 'col': token.column}
+    return {'row': token.line + line_offset, 'col': token.column}
 
 
 class JSONTransformer(lark.Transformer):
-    def __init__(self, include_pos=False):
+    def __init__(self, include_pos=False, line_offset=0):
         super().__init__()
         self.include_pos = include_pos
+        self.line_offset = line_offset
 
     def start(self, items):
         structs = [i for i in items if 'mbrs' in i]
@@ -97,7 +107,7 @@ class JSONTransformer(lark.Transformer):
         if typ:
             func['type'] = typ
         if self.include_pos:
-            func['pos'] = _pos(name)
+            func['pos'] = _pos(name, self.line_offset)
         return func
 
     def arg(self, items):
@@ -137,7 +147,7 @@ class JSONTransformer(lark.Transformer):
         if type:
             out['type'] = type
         if self.include_pos:
-            out['pos'] = _pos(dest)
+            out['pos'] = _pos(dest, self.line_offset)
         return out
 
     def vop(self, items):
@@ -147,7 +157,7 @@ class JSONTransformer(lark.Transformer):
             out['type'] = type
         out.update(op)
         if self.include_pos:
-            out['pos'] = _pos(dest)
+            out['pos'] = _pos(dest, self.line_offset)
         return out
 
     def op(self, items):
@@ -173,7 +183,7 @@ class JSONTransformer(lark.Transformer):
         if labels:
             out['labels'] = labels
         if self.include_pos:
-            out['pos'] = _pos(op_token)
+            out['pos'] = _pos(op_token, self.line_offset)
         return out
 
     def eop(self, items):
@@ -186,7 +196,7 @@ class JSONTransformer(lark.Transformer):
             'label': str(name)[1:]  # Strip `.`.
         }
         if self.include_pos:
-            out['pos'] = _pos(name)
+            out['pos'] = _pos(name, self.line_offset)
         return out
 
     def int(self, items):
@@ -211,17 +221,471 @@ class JSONTransformer(lark.Transformer):
         return 0
 
 
-def parse_bril(txt, include_pos=False):
+# Hand-written parser backend. This tokenizes and parses in a single pass,
+# building the same JSON data as `JSONTransformer` without an intermediate
+# parse tree.
+
+_TOKEN_RE = re.compile(r'''
+    [ \t\f\r]*
+    (?:
+        (?P<COMMENT>\#.*)
+      | (?P<FUNC>@[_%A-Za-z][_%.A-Za-z0-9]*)
+      | (?P<NUMBER>[+-]?(?:[0-9]+\.[0-9]*|\.[0-9]+|[0-9]+)(?:[eE][+-]?[0-9]+)?)
+      | (?P<LABEL>\.[_%A-Za-z][_%.A-Za-z0-9]*)
+      | (?P<IDENT>[_%A-Za-z][_%.A-Za-z0-9]*)
+      | (?P<PUNCT>[(){}<>:;,=])
+      | (?P<ERROR>\S)
+    )
+''', re.VERBOSE)
+_INT_RE = re.compile(r'[+-]?[0-9]+$')
+
+
+class _Token(str):
+    """A string with a token type and a source position, standing in for
+    Lark tokens.
+    """
+    __slots__ = ('type', 'line', 'column')
+
+    def __new__(cls, type, value, line, column):
+        tok = super().__new__(cls, value)
+        tok.type = type
+        tok.line = line
+        tok.column = column
+        return tok
+
+
+def tokenize(txt):
+    """Generate the tokens in a Bril text program, skipping whitespace
+    and comments.
+    """
+    for line, text in enumerate(txt.split('\n'), 1):
+        for match in _TOKEN_RE.finditer(text):
+            kind = match.lastgroup
+            if kind == 'COMMENT':
+                break
+            start = match.start(kind)
+            if kind == 'ERROR':
+                raise ValueError('{}:{}: unexpected character {!r}'.format(
+                    line, start + 1, match.group(kind),
+                ))
+            value = match.group(kind)
+            yield _Token(value if kind == 'PUNCT' else kind, value,
+                         line, start + 1)
+
+
+class RDParser:
+    """A recursive-descent parser for the text format.
+
+    This is a faster alternative to the Lark parsers; it produces
+    exactly the same JSON data.
+    """
+    def __init__(self, include_pos=False, line_offset=0):
+        self.include_pos = include_pos
+        self.line_offset = line_offset
+
+    def parse(self, txt):
+        self.tokens = list(tokenize(txt))
+        self.tokens.append(_Token('$END', '', 0, 0))
+        self.idx = 0
+
+        structs = []
+        funcs = []
+        while self.peek().type != '$END':
+            if self.peek() == 'struct':
+                structs.append(self.struct())
+            else:
+                funcs.append(self.func())
+        if structs:
+            return {
+                'structs': structs,
+                'functions': funcs,
+            }
+        else:
+            return {
+                'functions': funcs,
+            }
+
+    def peek(self, offset=0):
+        return self.tokens[self.idx + offset]
+
+    def next(self):
+        tok = self.tokens[self.idx]
+        self.idx += 1
+        return tok
+
+    def accept(self, type):
+        """Consume the next token if it has the given type."""
+        if self.tokens[self.idx].type == type:
+            self.idx += 1
+            return True
+        return False
+
+    def expect(self, type, value=None):
+        tok = self.next()
+        if tok.type != type or (value is not None and tok != value):
+            if tok.type == '$END':
+                raise ValueError('unexpected end of input, expected {}'
+                                 .format(value or type))
+            raise ValueError('{}:{}: unexpected token {!r}, expected {}'
+                             .format(tok.line + self.line_offset,
+                                     tok.column, str(tok), value or type))
+        return tok
+
+    def struct(self):
+        self.expect('IDENT', 'struct')
+        name = self.expect('IDENT')
+        self.expect('=')
+        self.expect('{')
+        mbrs = []
+        while not self.accept('}'):
+            mbrs.append(self.arg())
+            self.expect(';')
+        return {
+            'name': str(name),
+            'mbrs': mbrs,
+        }
+
+    def func(self):
+        name = self.expect('FUNC')
+        args = []
+        if self.accept('('):
+            if not self.accept(')'):
+                args.append(self.arg())
+                while self.accept(','):
+                    args.append(self.arg())
+                self.expect(')')
+        typ = self.type() if self.accept(':') else None
+        self.expect('{')
+        instrs = []
+        while not self.accept('}'):
+            instrs.append(self.instr())
+
+        func = {
+            'name': str(name)[1:],  # Strip `@`.
+            'instrs': instrs,
+        }
+        if args:
+            func['args'] = args
+        if typ:
+            func['type'] = typ
+        if self.include_pos:
+            func['pos'] = _pos(name, self.line_offset)
+        return func
+
+    def arg(self):
+        name = self.expect('IDENT')
+        self.expect(':')
+        return {
+            'name': str(name),
+            'type': self.type(),
+        }
+
+    def type(self):
+        name = str(self.expect('IDENT'))
+        if self.accept('<'):
+            param = self.type()
+            self.expect('>')
+            return {name: param}
+        return name
+
+    def instr(self):
+        tok = self.peek()
+        if tok.type == 'LABEL':
+            self.next()
+            self.expect(':')
+            out = {'label': str(tok)[1:]}  # Strip `.`.
+            if self.include_pos:
+                out['pos'] = _pos(tok, self.line_offset)
+            return out
+
+        # Value instructions start with `dest:` or `dest =`.
+        if tok.type == 'IDENT' and self.peek(1).type in (':', '='):
+            dest = self.expect('IDENT')
+            typ = self.type() if self.accept(':') else None
+            self.expect('=')
+            if self.peek() == 'const':
+                self.next()
+                out = {
+                    'op': 'const',
+                    'dest': str(dest),
+                    'value': self.lit(),
+                }
+            else:
+                out = {'dest': str(dest)}
+                out.update(self.op())
+            if typ:
+                out['type'] = typ
+            if self.include_pos:
+                out['pos'] = _pos(dest, self.line_offset)
+        else:
+            out = self.op()
+        self.expect(';')
+        return out
+
+    def op(self):
+        op_token = self.expect('IDENT')
+
+        funcs = []
+        labels = []
+        args = []
+        while True:
+            tok = self.peek()
+            if tok.type == 'FUNC':
+                funcs.append(str(tok)[1:])
+            elif tok.type == 'LABEL':
+                labels.append(str(tok)[1:])
+            elif tok.type == 'IDENT':
+                args.append(str(tok))
+            else:
+                break
+            self.idx += 1
+
+        out = {'op': str(op_token)}
+        if args:
+            out['args'] = args
+        if funcs:
+            out['funcs'] = funcs
+        if labels:
+            out['labels'] = labels
+        if self.include_pos:
+            out['pos'] = _pos(op_token, self.line_offset)
+        return out
+
+    def lit(self):
+        tok = self.next()
+        if tok.type == 'NUMBER':
+            if _INT_RE.match(tok):
+                return int(tok)
+            return float(tok)
+        elif tok == 'true':
+            return True
+        elif tok == 'false':
+            return False
+        elif tok == 'nullptr':
+            return 0
+        raise ValueError('{}:{}: invalid literal {!r}'.format(
+            tok.line + self.line_offset, tok.column, str(tok),
+        ))
+
+
+@functools.lru_cache(maxsize=None)
+def get_parser(earley=False):
+    """Get a Lark parser for the text format.
+
+    The parser is built once per process. By default, this is an LALR
+    parser, which Lark caches on disk so later processes can skip
+    grammar compilation. Pass `earley=True` to get the (much slower)
+    Earley parser instead.
+    """
+    if earley:
+        return lark.Lark(GRAMMAR, maybe_placeholders=True)
+    else:
+        return lark.Lark(GRAMMAR, parser='lalr', maybe_placeholders=True,
+                         cache=True)
+
+
+# The available parser backends. The default can be set with the
+# `BRILTXT_BACKEND` environment variable.
+BACKENDS = ('lalr', 'earley', 'rd')
+DEFAULT_BACKEND = os.environ.get('BRILTXT_BACKEND', 'lalr')
+
+
+def parse_data(txt, include_pos=False, backend=None, line_offset=0):
+    """Parse a Bril program and return its JSON data structure.
+
+    `backend` is one of `BACKENDS`: the Lark LALR or Earley parsers, or
+    the hand-written recursive-descent parser. All produce the same
+    output. Source positions are shifted down by `line_offset` lines.
+    """
+    backend = backend or DEFAULT_BACKEND
+    if backend == 'rd':
+        return RDParser(include_pos, line_offset).parse(txt)
+    elif backend in BACKENDS:
+        tree = get_parser(backend == 'earley').parse(txt)
+        return JSONTransformer(include_pos, line_offset).transform(tree)
+    else:
+        raise ValueError('unknown parser backend {}'.format(backend))
+
+
+def parse_bril(txt, include_pos=False, backend=None):
     """Parse a Bril program and return a JSON string.
 
     Optionally include source position information.
     """
-    parser = lark.Lark(GRAMMAR, maybe_placeholders=True)
-    tree = parser.parse(txt)
-    data = JSONTransformer(include_pos).transform(tree)
+    data = parse_data(txt, include_pos, backend)
     return json.dumps(data, indent=2, sort_keys=True)
 
 
+def split_toplevel(lines):
+    """Split Bril source text into top-level declarations.
+
+    Take an iterable of lines and generate `(text, row, col)` tuples,
+    where each `text` holds at most one complete struct or function and
+    `row` and `col` give the (1-based) position where it starts. Only
+    one declaration is ever held in memory at a time.
+    """
+    chunk = []
+    depth = 0
+    start = None
+    for row, line in enumerate(lines, 1):
+        if start is None:
+            start = (row, 1)
+        col = 0
+        for match in re.finditer(r'[{}#]', line):
+            char = match.group()
+            if char == '#':
+                break
+            elif char == '{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    # End of a declaration: emit it and start the next
+                    # one from the rest of this line.
+                    end = match.end()
+                    chunk.append(line[col:end])
+                    yield ''.join(chunk), start[0], start[1]
+                    chunk = []
+                    col = end
+                    start = (row, end + 1)
+        chunk.append(line[col:])
+    if chunk:
+        yield ''.join(chunk), start[0], start[1]
+
+
+def parse_bril_stream(lines, include_pos=False, backend=None):
+    """Parse a Bril program one declaration at a time.
+
+    Generate the JSON dict for each struct and function as soon as it
+    has been parsed.
+    """
+    for text, row, col in split_toplevel(lines):
+        # Pad the first line so that the parser's columns stay correct.
+        data = parse_data(' ' * (col - 1) + text, include_pos, backend,
+                          row - 1)
+        yield from data.get('structs', [])
+        yield from data['functions']
+
+
+def _dump_list(items, key, out):
+    """Write a list of dicts as the value of a top-level JSON key,
+    formatted exactly as `json.dumps(..., indent=2, sort_keys=True)`
+    would do it.
+    """
+    out.write('  "{}": ['.format(key))
+    first = True
+    for item in items:
+        out.write('\n' if first else ',\n')
+        first = False
+        text = json.dumps(item, indent=2, sort_keys=True)
+        out.write('    ' + text.replace('\n', '\n    '))
+        out.flush()
+    out.write(']' if first else '\n  ]')
+
+
+def dump_bril_stream(items, out):
+    """Write a stream of parsed structs and functions as a Bril JSON
+    program.
+
+    Functions are written as soon as they arrive; structs are collected
+    and written at the end (after `functions`, following key order).
+    """
+    structs = []
+
+    def funcs():
+        for item in items:
+            if 'mbrs' in item:
+                structs.append(item)
+            else:
+                yield item
+
+    out.write('{\n')
+    _dump_list(funcs(), 'functions', out)
+    if structs:
+        out.write(',\n')
+        _dump_list(structs, 'structs', out)
+    out.write('\n}\n')
+
+
+# Source maps. Instead of a `pos` dict on every function and instruction,
+# a source map stores the positions out of line, like this:
+#
+#   {"functions": {"main": {"pos": [1, 1], "instrs": [2, 3, 3, 3, ...]}}}
+#
+# Each function's `instrs` is a flat list holding a row and a column for
+# each element of its `instrs` array (labels included), or 0, 0 for
+# elements without a position.
+
+def extract_source_map(prog):
+    """Remove the `pos` fields from a program and return them as a
+    source map.
+    """
+    funcs = {}
+    for func in prog['functions']:
+        entry = {}
+        if 'pos' in func:
+            pos = func.pop('pos')
+            entry['pos'] = [pos['row'], pos['col']]
+        rowcols = []
+        for instr in func['instrs']:
+            pos = instr.pop('pos', None)
+            if pos:
+                rowcols += [pos['row'], pos['col']]
+            else:
+                rowcols += [0, 0]
+        if any(rowcols):
+            entry['instrs'] = rowcols
+        if entry:
+            funcs[func['name']] = entry
+    return {'functions': funcs}
+
+
+def dump_source_map(srcmap, out):
+    """Write a source map compactly to a file-like object."""
+    json.dump(srcmap, out, separators=(',', ':'))
+    out.write('\n')
+
+
+def load_source_map(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def func_pos(srcmap, func_name):
+    """Look up the position of a function in a source map, or None."""
+    entry = srcmap['functions'].get(func_name, {})
+    if 'pos' in entry:
+        row, col = entry['pos']
+        return {'row': row, 'col': col}
+    return None
+
+
+def instr_pos(srcmap, func_name, index):
+    """Look up the position of the `index`th element of a function's
+    `instrs` array in a source map, or None if it has none.
+    """
+    rowcols = srcmap['functions'].get(func_name, {}).get('instrs')
+    if rowcols and 0 <= index < len(rowcols) // 2:
+        row, col = rowcols[2 * index], rowcols[2 * index + 1]
+        if row:
+            return {'row': row, 'col': col}
+    return None
+
+
+def apply_source_map(prog, srcmap):
+    """Put the positions from a source map back inline as `pos` fields,
+    for tools that expect them there.
+    """
+    for func in prog['functions']:
+        pos = func_pos(srcmap, func['name'])
+        if pos:
+            func['pos'] = pos
+        for i, instr in enumerate(func['instrs']):
+            pos = instr_pos(srcmap, func['name'], i)
+            if pos:
+                instr['pos'] = pos
+
+
 # Text format pretty-printer.
 
 def type_to_str(type):
@@ -266,12 +730,16 @@ def instr_to_string(instr):
             return rhs
 
 
+def label_to_string(label):
+    return '.{}:'.format(label['label'])
+
+
 def print_instr(instr):
     print('  {};'.format(instr_to_string(instr)))
 
 
 def print_label(label):
-    print('.{}:'.format(label['label']))
+    print(label_to_string(label))
 
 
 def args_to_string(args):
@@ -284,31 +752,754 @@ def args_to_string(args):
         return ''
 
 
-def print_func(func):
+def func_lines(func):
+    """Generate the lines of text for a function."""
     typ = func.get('type', 'void')
-    print('@{}{}{} {{'.format(
+    yield '@{}{}{} {{'.format(
         func['name'],
         args_to_string(func.get('args', [])),
         ': {}'.format(type_to_str(typ)) if typ != 'void' else '',
-    ))
+    )
     for instr_or_label in func['instrs']:
         if 'label' in instr_or_label:
-            print_label(instr_or_label)
+            yield label_to_string(instr_or_label)
         else:
-            print_instr(instr_or_label)
-    print('}')
+            yield '  {};'.format(instr_to_string(instr_or_label))
+    yield '}'
+
+
+def write_funcs(funcs, out, bufsize=1 << 16):
+    """Pretty-print a sequence of functions to a file-like object.
+
+    Lines are collected in a buffer and written out in chunks of about
+    `bufsize` characters, instead of one `write` per line.
+    """
+    buf = []
+    size = 0
+    for func in funcs:
+        for line in func_lines(func):
+            buf.append(line)
+            size += len(line)
+            if size >= bufsize:
+                buf.append('')
+                out.write('\n'.join(buf))
+                buf = []
+                size = 0
+    if buf:
+        buf.append('')
+        out.write('\n'.join(buf))
+
+
+def print_func(func):
+    write_funcs([func], sys.stdout)
 
 
 def print_prog(prog):
-    for func in prog['functions']:
-        print_func(func)
+    write_funcs(prog['functions'], sys.stdout)
+
+
+# Incremental JSON input.
+
+def _skip_ws(buf, idx):
+    while idx < len(buf) and buf[idx] in ' \t\n\r':
+        idx += 1
+    return idx
+
+
+def load_funcs_stream(infile, chunk_size=1 << 16):
+    """Decode the functions of a JSON Bril program incrementally.
+
+    Read `infile` in chunks and generate each function in the
+    `functions` array as soon as it has been decoded, so the whole
+    document never needs to be in memory at once. Other top-level
+    values (i.e., `structs`) are decoded and skipped.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    idx = 0
+    eof = False
+
+    def fill(need_more):
+        """Read more input. When a value failed to decode, read until
+        the unconsumed buffer doubles so that each value is retried
+        only a logarithmic number of times.
+        """
+        nonlocal buf, idx, eof
+        buf = buf[idx:]
+        idx = 0
+        target = max(len(buf) * 2, chunk_size) if need_more else chunk_size
+        chunks = [buf]
+        size = len(buf)
+        while size < target:
+            chunk = infile.read(chunk_size)
+            if not chunk:
+                eof = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        buf = ''.join(chunks)
+
+    def token(expected):
+        """Consume one of the punctuation characters in `expected`."""
+        nonlocal idx
+        while True:
+            idx = _skip_ws(buf, idx)
+            if idx < len(buf):
+                break
+            if eof:
+                raise ValueError('unexpected end of JSON input')
+            fill(False)
+        char = buf[idx]
+        if char not in expected:
+            raise ValueError('expected one of {!r} in JSON input, found '
+                             '{!r}'.format(expected, char))
+        idx += 1
+        return char
+
+    def value():
+        """Decode the next complete JSON value."""
+        nonlocal idx
+        while True:
+            idx = _skip_ws(buf, idx)
+            try:
+                val, end = decoder.raw_decode(buf, idx)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # A number is only complete once we see what follows it;
+                # it might continue in the next chunk. (Keys and
+                # functions are never bare numbers, but other top-level
+                # values might be.)
+                if not isinstance(val, (int, float)) or eof or \
+                        (end < len(buf) and buf[end] in ' \t\n\r,]}'):
+                    idx = end
+                    return val
+            fill(True)
+
+    fill(False)
+    token('{')
+    if token('"}') == '}':
+        return
+    idx -= 1
+    while True:
+        key = value()
+        token(':')
+        if key == 'functions':
+            token('[')
+            if token('{]') == '{':
+                idx -= 1
+                while True:
+                    yield value()
+                    if token(',]') == ']':
+                        break
+        else:
+            value()
+        if token(',}') == '}':
+            break
+
+
+# Binary format.
+#
+# A compact binary encoding of Bril programs. The layout is:
+#
+#   magic (b'BRIL'), version (1 byte)
+#   string table: count, then (byte length, UTF-8 bytes) for each string
+#   top-level values other than `functions` (e.g., `structs`): a value
+#   function count, then (byte length, function record) for each one
+#   index: (name, offset) for each function record
+#   index offset (8 bytes, little-endian)
+#
+# All counts, lengths, offsets, and string references (indices into the
+# string table) are unsigned LEB128 varints. Opcodes, variable names,
+# labels, and function names all live in the string table. Because each
+# function record has a length prefix, programs can be read one function
+# at a time from a pipe; the index at the end allows seeking directly to
+# a function in a file.
+
+BIN_MAGIC = b'BRIL'
+BIN_VERSION = 1
+
+# Tags for generic values.
+_NULL, _FALSE, _TRUE, _INT, _FLOAT, _STR, _LIST, _DICT = range(8)
+
+# Bit flags for the instruction and function fields present in a record.
+# Any other fields are stored as generic key/value pairs.
+_INSTR_FIELDS = ('op', 'dest', 'type', 'args', 'funcs', 'labels', 'value',
+                 'label', 'pos')
+_FUNC_FIELDS = ('args', 'type', 'pos')
+_EXTRA = 1 << 9
+
+
+def _write_varint(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _read_varint(data, idx):
+    n = data[idx]
+    if n < 0x80:  # Fast path for single-byte values.
+        return n, idx + 1
+    n = 0
+    shift = 0
+    while True:
+        byte = data[idx]
+        idx += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, idx
+        shift += 7
+
+
+def _is_pos(pos):
+    return (isinstance(pos, dict) and pos.keys() == {'row', 'col'}
+            and all(type(v) is int and v >= 0 for v in pos.values()))
+
+
+class BinEncoder:
+    """Encode Bril programs in the binary format."""
+    def __init__(self):
+        self.strings = {}
+
+    def string(self, buf, s):
+        """Write a reference to `s`, adding it to the string table."""
+        idx = self.strings.get(s)
+        if idx is None:
+            idx = self.strings[s] = len(self.strings)
+        _write_varint(buf, idx)
+
+    def value(self, buf, val):
+        """Write a generic (JSON) value."""
+        if val is None:
+            buf.append(_NULL)
+        elif val is True:
+            buf.append(_TRUE)
+        elif val is False:
+            buf.append(_FALSE)
+        elif isinstance(val, int):
+            buf.append(_INT)
+            _write_varint(buf, val * 2 if val >= 0 else -val * 2 - 1)
+        elif isinstance(val, float):
+            buf.append(_FLOAT)
+            buf += struct.pack('<d', val)
+        elif isinstance(val, str):
+            buf.append(_STR)
+            self.string(buf, val)
+        elif isinstance(val, list):
+            buf.append(_LIST)
+            _write_varint(buf, len(val))
+            for item in val:
+                self.value(buf, item)
+        elif isinstance(val, dict):
+            buf.append(_DICT)
+            _write_varint(buf, len(val))
+            for k, v in val.items():
+                self.string(buf, k)
+                self.value(buf, v)
+        else:
+            raise TypeError('cannot encode {!r}'.format(val))
+
+    def names(self, buf, names):
+        _write_varint(buf, len(names))
+        for name in names:
+            self.string(buf, name)
+
+    def extras(self, buf, obj, fields):
+        extras = [(k, v) for k, v in obj.items() if k not in fields]
+        _write_varint(buf, len(extras))
+        for k, v in extras:
+            self.string(buf, k)
+            self.value(buf, v)
+
+    def instr(self, buf, instr):
+        flags = 0
+        for i, field in enumerate(_INSTR_FIELDS):
+            if field in instr:
+                flags |= 1 << i
+        if 'pos' in instr and not _is_pos(instr['pos']):
+            flags &= ~(1 << _INSTR_FIELDS.index('pos'))
+            fields = _INSTR_FIELDS[:-1]
+        else:
+            fields = _INSTR_FIELDS
+        extra = any(k not in fields for k in instr)
+        if extra:
+            flags |= _EXTRA
+        _write_varint(buf, flags)
+
+        if 'op' in instr:
+            self.string(buf, instr['op'])
+        if 'dest' in instr:
+            self.string(buf, instr['dest'])
+        if 'type' in instr:
+            self.value(buf, instr['type'])
+        for field in ('args', 'funcs', 'labels'):
+            if field in instr:
+                self.names(buf, instr[field])
+        if 'value' in instr:
+            self.value(buf, instr['value'])
+        if 'label' in instr:
+            self.string(buf, instr['label'])
+        if flags & (1 << _INSTR_FIELDS.index('pos')):
+            _write_varint(buf, instr['pos']['row'])
+            _write_varint(buf, instr['pos']['col'])
+        if extra:
+            self.extras(buf, instr, fields)
+
+    def func(self, func):
+        """Encode a function record."""
+        buf = bytearray()
+        self.string(buf, func['name'])
+
+        fields = ('name', 'instrs') + _FUNC_FIELDS
+        if 'pos' in func and not _is_pos(func['pos']):
+            fields = fields[:-1]
+        flags = 0
+        for i, field in enumerate(_FUNC_FIELDS):
+            if field in fields and field in func:
+                flags |= 1 << i
+        extra = any(k not in fields for k in func)
+        if extra:
+            flags |= _EXTRA
+        _write_varint(buf, flags)
+
+        if 'args' in func:
+            _write_varint(buf, len(func['args']))
+            for arg in func['args']:
+                self.value(buf, arg)
+        if 'type' in func:
+            self.value(buf, func['type'])
+        if flags & (1 << _FUNC_FIELDS.index('pos')):
+            _write_varint(buf, func['pos']['row'])
+            _write_varint(buf, func['pos']['col'])
+        if extra:
+            self.extras(buf, func, fields)
+
+        _write_varint(buf, len(func['instrs']))
+        for instr in func['instrs']:
+            self.instr(buf, instr)
+        return buf
+
+    def encode(self, prog):
+        """Encode an entire program as `bytes`."""
+        records = [self.func(f) for f in prog['functions']]
+        rest = bytearray()
+        self.value(rest, {k: v for k, v in prog.items()
+                          if k != 'functions'})
+
+        out = bytearray(BIN_MAGIC)
+        out.append(BIN_VERSION)
+        _write_varint(out, len(self.strings))
+        for s in self.strings:
+            data = s.encode('utf8')
+            _write_varint(out, len(data))
+            out += data
+        out += rest
+
+        _write_varint(out, len(records))
+        offsets = []
+        for record in records:
+            offsets.append(len(out))
+            _write_varint(out, len(record))
+            out += record
+
+        index_offset = len(out)
+        for func, offset in zip(prog['functions'], offsets):
+            self.string(out, func['name'])
+            _write_varint(out, offset)
+        out += struct.pack('<Q', index_offset)
+        return bytes(out)
+
+
+def encode_bin(prog):
+    """Encode a Bril program (as JSON data) in the binary format."""
+    return BinEncoder().encode(prog)
+
+
+class BinReader:
+    """Read a Bril program in the binary format from a binary file.
+
+    The header and string table are read immediately. Then, use
+    `functions()` to read functions one at a time (which works on
+    pipes) or `function(name)` to seek directly to a single function
+    (which requires a seekable file).
+    """
+    def __init__(self, infile):
+        self.infile = infile
+        if infile.read(len(BIN_MAGIC)) != BIN_MAGIC:
+            raise ValueError('not a binary Bril file')
+        version = infile.read(1)
+        if version != bytes([BIN_VERSION]):
+            raise ValueError('unsupported binary Bril version {}'
+                             .format(version[0] if version else None))
+
+        self.strings = []
+        for _ in range(self._read_varint()):
+            data = self._read_exactly(self._read_varint())
+            self.strings.append(data.decode('utf8'))
+
+        # Read the remaining top-level values (a dict) byte by byte:
+        # they are small, and there is no length prefix.
+        self.extras = self._read_stream_value()
+        self.nfuncs = self._read_varint()
+        self._index = None
+
+    def _read_exactly(self, n):
+        data = self.infile.read(n)
+        if len(data) != n:
+            raise ValueError('unexpected end of binary Bril input')
+        return data
+
+    def _read_varint(self):
+        data = bytearray()
+        while True:
+            byte = self._read_exactly(1)[0]
+            data.append(byte)
+            if byte < 0x80:
+                return _read_varint(data, 0)[0]
+
+    def _read_stream_value(self):
+        tag = self._read_exactly(1)[0]
+        if tag == _FLOAT:
+            return struct.unpack('<d', self._read_exactly(8))[0]
+        elif tag in (_INT, _STR):
+            n = self._read_varint()
+            return self._finish_scalar(tag, n)
+        elif tag == _LIST:
+            return [self._read_stream_value()
+                    for _ in range(self._read_varint())]
+        elif tag == _DICT:
+            out = {}
+            for _ in range(self._read_varint()):
+                key = self.strings[self._read_varint()]
+                out[key] = self._read_stream_value()
+            return out
+        return self._finish_scalar(tag, None)
+
+    def _finish_scalar(self, tag, n):
+        if tag == _NULL:
+            return None
+        elif tag == _FALSE:
+            return False
+        elif tag == _TRUE:
+            return True
+        elif tag == _INT:
+            return n >> 1 if not n & 1 else -((n + 1) >> 1)
+        elif tag == _STR:
+            return self.strings[n]
+        raise ValueError('invalid binary Bril value tag {}'.format(tag))
+
+    def _value(self, data, idx):
+        tag = data[idx]
+        idx += 1
+        if tag == _FLOAT:
+            return struct.unpack_from('<d', data, idx)[0], idx + 8
+        elif tag in (_INT, _STR):
+            n, idx = _read_varint(data, idx)
+            return self._finish_scalar(tag, n), idx
+        elif tag == _LIST:
+            count, idx = _read_varint(data, idx)
+            out = []
+            for _ in range(count):
+                item, idx = self._value(data, idx)
+                out.append(item)
+            return out, idx
+        elif tag == _DICT:
+            count, idx = _read_varint(data, idx)
+            out = {}
+            for _ in range(count):
+                key, idx = _read_varint(data, idx)
+                out[self.strings[key]], idx = self._value(data, idx)
+            return out, idx
+        return self._finish_scalar(tag, None), idx
+
+    def _names(self, data, idx):
+        strings = self.strings
+        count, idx = _read_varint(data, idx)
+        out = []
+        for _ in range(count):
+            n, idx = _read_varint(data, idx)
+            out.append(strings[n])
+        return out, idx
+
+    def _extras(self, data, idx, obj):
+        count, idx = _read_varint(data, idx)
+        for _ in range(count):
+            key, idx = _read_varint(data, idx)
+            obj[self.strings[key]], idx = self._value(data, idx)
+        return idx
+
+    def _instr(self, data, idx):
+        strings = self.strings
+        flags, idx = _read_varint(data, idx)
+        instr = {}
+        if flags & 1:
+            n, idx = _read_varint(data, idx)
+            instr['op'] = strings[n]
+        if flags & 2:
+            n, idx = _read_varint(data, idx)
+            instr['dest'] = strings[n]
+        if flags & 4:
+            instr['type'], idx = self._value(data, idx)
+        if flags & 8:
+            instr['args'], idx = self._names(data, idx)
+        if flags & 16:
+            instr['funcs'], idx = self._names(data, idx)
+        if flags & 32:
+            instr['labels'], idx = self._names(data, idx)
+        if flags & 64:
+            instr['value'], idx = self._value(data, idx)
+        if flags & 128:
+            n, idx = _read_varint(data, idx)
+            instr['label'] = strings[n]
+        if flags & 256:
+            row, idx = _read_varint(data, idx)
+            col, idx = _read_varint(data, idx)
+            instr['pos'] = {'row': row, 'col': col}
+        if flags & _EXTRA:
+            idx = self._extras(data, idx, instr)
+        return instr, idx
+
+    def _func(self, data):
+        name, idx = _read_varint(data, 0)
+        func = {'name': self.strings[name]}
+        flags, idx = _read_varint(data, idx)
+        if flags & 1:
+            count, idx = _read_varint(data, idx)
+            func['args'] = []
+            for _ in range(count):
+                arg, idx = self._value(data, idx)
+                func['args'].append(arg)
+        if flags & 2:
+            func['type'], idx = self._value(data, idx)
+        if flags & 4:
+            row, idx = _read_varint(data, idx)
+            col, idx = _read_varint(data, idx)
+            func['pos'] = {'row': row, 'col': col}
+        if flags & _EXTRA:
+            idx = self._extras(data, idx, func)
+
+        count, idx = _read_varint(data, idx)
+        instrs = func['instrs'] = []
+        for _ in range(count):
+            instr, idx = self._instr(data, idx)
+            instrs.append(instr)
+        return func
+
+    def functions(self):
+        """Generate the program's functions in order.
+
+        This reads sequentially from the current position, so it can
+        only be used once (unless the file is seekable and you seek
+        back).
+        """
+        for _ in range(self.nfuncs):
+            yield self._func(self._read_exactly(self._read_varint()))
+
+    def index(self):
+        """Get a dict mapping function names to record offsets."""
+        if self._index is None:
+            self.infile.seek(-8, 2)
+            offset, = struct.unpack('<Q', self._read_exactly(8))
+            self.infile.seek(offset)
+            self._index = {}
+            for _ in range(self.nfuncs):
+                name = self.strings[self._read_varint()]
+                self._index[name] = self._read_varint()
+        return self._index
+
+    def function(self, name):
+        """Read a single function by name, seeking directly to it."""
+        self.infile.seek(self.index()[name])
+        return self._func(self._read_exactly(self._read_varint()))
+
+    def program(self):
+        """Read the rest of the program and return its JSON data."""
+        prog = {'functions': list(self.functions())}
+        prog.update(self.extras)
+        return prog
+
+
+def decode_bin(data):
+    """Decode a Bril program from `bytes` in the binary format."""
+    return BinReader(io.BytesIO(data)).program()
+
+
+# Batch conversion.
+
+def convert_file(job):
+    """Convert a single file for batch mode.
+
+    `job` is a tuple `(kind, in_path, out_path, include_pos, backend)`
+    where `kind` is `'json'` (text to JSON) or `'txt'` (JSON to text).
+    Return the time taken in seconds.
+    """
+    kind, in_path, out_path, include_pos, backend = job
+    start = time.perf_counter()
+    # Write to a temporary file first, so a file that fails to convert
+    # doesn't leave a partial output behind.
+    tmp_path = '{}.{}.tmp'.format(out_path, os.getpid())
+    try:
+        with open(in_path) as f, open(tmp_path, 'w') as out:
+            if kind == 'json':
+                out.write(parse_bril(f.read(), include_pos, backend))
+                out.write('\n')
+            else:
+                write_funcs(json.load(f)['functions'], out)
+        os.replace(tmp_path, out_path)
+    except Exception as exc:
+        # Parse errors can't always be pickled to send them back from a
+        # worker process.
+        raise ValueError('{}: {}'.format(in_path, exc)) from None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return time.perf_counter() - start
+
+
+def run_batch(kind, files, out_dir, ext, jobs=None, include_pos=False,
+              backend=None, log=sys.stderr):
+    """Convert many files in one process (or one pool of processes).
+
+    Each input file is written to `out_dir` with its extension replaced
+    by `ext`. Work is spread over `jobs` worker processes (or runs
+    in-process if `jobs` is 1); each worker builds its parser only once.
+    Per-file and total times are reported to `log` in input order.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    batch = []
+    outputs = set()
+    for in_path in files:
+        base, _ = os.path.splitext(os.path.basename(in_path))
+        out_path = os.path.join(out_dir, base + ext)
+        if out_path in outputs:
+            raise ValueError('multiple inputs would be written to {}'
+                             .format(out_path))
+        outputs.add(out_path)
+        batch.append((kind, in_path, out_path, include_pos, backend))
+
+    start = time.perf_counter()
+    if jobs == 1:
+        times = [convert_file(job) for job in batch]
+    else:
+        with futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            times = list(pool.map(convert_file, batch))
+    total = time.perf_counter() - start
+
+    for (_, in_path, out_path, _, _), elapsed in zip(batch, times):
+        print('{} -> {}: {:.1f} ms'.format(in_path, out_path,
+                                           elapsed * 1000), file=log)
+    print('{} files: {:.1f} ms total, {:.1f} ms converting'.format(
+        len(batch), total * 1000, sum(times) * 1000,
+    ), file=log)
+
+
+def _batch_main(kind, ext):
+    """Parse the command line for batch mode and run it."""
+    parser = argparse.ArgumentParser(
+        prog='bril2' + kind,
+        description='Convert many files at once.',
+    )
+    parser.add_argument('--batch', action='store_true', required=True)
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('-o', '--out-dir', required=True,
+                        help='directory for the converted files')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    if kind == 'json':
+        parser.add_argument('-p', dest='include_pos', action='store_true',
+                            help='include source positions')
+        for backend in BACKENDS:
+            parser.add_argument('--' + backend, dest='backend',
+                                action='store_const', const=backend)
+    args = parser.parse_args()
+    run_batch(kind, args.files, args.out_dir, ext, args.jobs,
+              getattr(args, 'include_pos', False),
+              getattr(args, 'backend', None))
 
 
 # Command-line entry points.
 
+def _backend_flag(argv):
+    """Get the parser backend selected on the command line, if any."""
+    for backend in BACKENDS:
+        if '--' + backend in argv:
+            return backend
+    return None
+
+
+def _flag_value(argv, flag):
+    """Get the value given after a command-line flag, if present."""
+    if flag in argv:
+        idx = argv.index(flag) + 1
+        if idx < len(argv):
+            return argv[idx]
+        sys.exit('{} requires a value'.format(flag))
+    return None
+
+
 def bril2json():
-    print(parse_bril(sys.stdin.read(), '-p' in sys.argv[1:]))
+    if '--batch' in sys.argv[1:]:
+        _batch_main('json', '.json')
+        return
+
+    # With a source map, positions go in a separate file.
+    map_path = _flag_value(sys.argv[1:], '--source-map')
+    include_pos = '-p' in sys.argv[1:] or map_path is not None
+    backend = _backend_flag(sys.argv[1:])
+    srcmap = {'functions': {}}
+
+    if '--stream' in sys.argv[1:]:
+        items = parse_bril_stream(sys.stdin, include_pos, backend)
+        if map_path:
+            items = _extract_stream(items, srcmap)
+        dump_bril_stream(items, sys.stdout)
+    else:
+        data = parse_data(sys.stdin.read(), include_pos, backend)
+        if map_path:
+            srcmap = extract_source_map(data)
+        print(json.dumps(data, indent=2, sort_keys=True))
+
+    if map_path:
+        with open(map_path, 'w') as f:
+            dump_source_map(srcmap, f)
+
+
+def _extract_stream(items, srcmap):
+    """Move positions from a stream of functions into a source map."""
+    for item in items:
+        if 'instrs' in item:
+            part = extract_source_map({'functions': [item]})
+            srcmap['functions'].update(part['functions'])
+        yield item
 
 
 def bril2txt():
-    print_prog(json.load(sys.stdin))
+    if '--batch' in sys.argv[1:]:
+        _batch_main('txt', '.bril')
+        return
+
+    if '--stream' in sys.argv[1:]:
+        funcs = load_funcs_stream(sys.stdin)
+    else:
+        funcs = json.load(sys.stdin)['functions']
+    write_funcs(funcs, sys.stdout)
+
+
+def bril2bin():
+    sys.stdout.buffer.write(encode_bin(json.load(sys.stdin)))
+
+
+def bin2bril():
+    reader = BinReader(sys.stdin.buffer)
+    if set(reader.extras) <= {'structs'} and \
+            reader.extras.get('structs', True):
+        # Stream functions straight through as they are decoded.
+        dump_bril_stream(
+            itertools.chain(reader.functions(),
+                            reader.extras.get('structs', [])),
+            sys.stdout,
+        )
+    else:
+        print(json.dumps(reader.program(), indent=2, sort_keys=True))
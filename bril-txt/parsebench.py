@@ -0,0 +1,121 @@
+"""Measure the throughput of the Bril text parser.
+
+Parses every file given on the command line, plus a synthetic program of
+the requested size, and reports throughput in instructions per second.
+For example:
+
+    $ python3 parsebench.py ../benchmarks/*.bril
+    $ python3 parsebench.py -b lalr -b earley --synth 1 ../benchmarks/*.bril
+
+Each selected parser backend is measured in turn so they can be compared.
+"""
+
+import argparse
+import json
+import time
+
+import briltxt
+
+
+def synth_program(size):
+    """Generate a Bril program of roughly `size` bytes of text.
+
+    The program is a sequence of functions, each with a small loop, so
+    that it exercises constants, value operations, labels, and branches.
+    """
+    funcs = []
+    total = 0
+    i = 0
+    while total < size:
+        lines = [
+            '@f{}(n: int): int {{'.format(i),
+            '  one: int = const 1;',
+            '  acc: int = const 0;',
+            '.loop:',
+        ]
+        for j in range(50):
+            lines.append('  v{0}: int = add acc n;'.format(j))
+            lines.append('  acc: int = mul v{0} one;'.format(j))
+        lines += [
+            '  n: int = sub n one;',
+            '  done: bool = le n one;',
+            '  br done .end .loop;',
+            '.end:',
+            '  ret acc;',
+            '}',
+        ]
+        func = '\n'.join(lines) + '\n'
+        funcs.append(func)
+        total += len(func)
+        i += 1
+    return ''.join(funcs)
+
+
+def count_instrs(json_str):
+    prog = json.loads(json_str)
+    return sum(len(f['instrs']) for f in prog['functions'])
+
+
+def bench(txt, backend):
+    start = time.perf_counter()
+    out = briltxt.parse_bril(txt, backend=backend)
+    elapsed = time.perf_counter() - start
+    ninstrs = count_instrs(out)
+    return ninstrs, elapsed
+
+
+def report(name, ninstrs, elapsed):
+    print('{:<24} {:>9} instrs {:>9.3f} s {:>12.0f} instrs/s'.format(
+        name, ninstrs, elapsed, ninstrs / elapsed if elapsed else 0,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*', help='Bril text files to parse')
+    parser.add_argument('-b', '--backend', action='append',
+                        choices=briltxt.BACKENDS,
+                        help='parser backend to measure (repeatable; '
+                             'default: lalr and rd)')
+    parser.add_argument('--synth', type=float, default=4.0, metavar='MB',
+                        help='size of the synthetic input (default: 4 MB)')
+    args = parser.parse_args()
+
+    backends = args.backend or ['lalr', 'rd']
+
+    sources = []
+    for fn in args.files:
+        with open(fn) as f:
+            sources.append(f.read())
+    synth = synth_program(int(args.synth * 1024 * 1024)) \
+        if args.synth else None
+
+    for backend in backends:
+        print('{}:'.format(backend))
+
+        # Build the parser up front so it doesn't count against any file.
+        if backend != 'rd':
+            start = time.perf_counter()
+            briltxt.get_parser(backend == 'earley')
+            print('parser construction: {:.3f} s'.format(
+                time.perf_counter() - start
+            ))
+
+        total_instrs = 0
+        total_time = 0.0
+        for txt in sources:
+            ninstrs, elapsed = bench(txt, backend)
+            total_instrs += ninstrs
+            total_time += elapsed
+        if sources:
+            report('{} files'.format(len(sources)), total_instrs,
+                   total_time)
+
+        if synth:
+            ninstrs, elapsed = bench(synth, backend)
+            report('synthetic {:.1f} MB'.format(len(synth) / 1024 / 1024),
+                   ninstrs, elapsed)
+
+
+if __name__ == '__main__':
+    main()
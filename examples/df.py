@@ -1,8 +1,10 @@
 import sys
 import json
+import heapq
 from collections import namedtuple
 
 from form_blocks import form_blocks
+from dom import postorder
 import cfg
 
 # A single dataflow analysis consists of these part:
@@ -10,7 +12,11 @@ import cfg
 # - init: An initial value (bottom or top of the latice).
 # - merge: Take a list of values and produce a single value.
 # - transfer: The transfer function.
-Analysis = namedtuple('Analysis', ['forward', 'init', 'merge', 'transfer'])
+# - summarize (optional): Summarize a block, once before iterating. If
+#   present, the transfer function gets the summary instead of the block.
+Analysis = namedtuple('Analysis',
+                      ['forward', 'init', 'merge', 'transfer', 'summarize'],
+                      defaults=[None])
 
 
 def union(sets):
@@ -20,12 +26,76 @@ def union(sets):
     return out
 
 
-def df_worklist(blocks, analysis):
+class Interner:
+    """Give names dense indices, so that a set of names can be a bit
+    vector: an int with the bit at each name's index set.
+    """
+    def __init__(self):
+        self.index = {}
+        self.names = []
+
+    def bit(self, name):
+        """Get the bit vector for a single name."""
+        i = self.index.get(name)
+        if i is None:
+            i = self.index[name] = len(self.names)
+            self.names.append(name)
+        return 1 << i
+
+    def bits(self, names):
+        out = 0
+        for name in names:
+            out |= self.bit(name)
+        return out
+
+    def decode(self, bits):
+        """Get the set of names in a bit vector."""
+        out = set()
+        while bits:
+            low = bits & -bits
+            out.add(self.names[low.bit_length() - 1])
+            bits ^= low
+        return out
+
+
+def bit_union(vals):
+    out = 0
+    for v in vals:
+        out |= v
+    return out
+
+
+def block_order(blocks, succs, forward):
+    """Order the blocks so that, as much as possible, each block comes
+    after the blocks its input flows from: reverse postorder for forward
+    analyses and postorder for backward ones. Blocks that are
+    unreachable from the entry go last, in their original order.
+    """
+    order = postorder(succs, next(iter(blocks)))
+    if forward:
+        order.reverse()
+    reachable = set(order)
+    return order + [name for name in blocks if name not in reachable]
+
+
+def df_worklist(blocks, analysis, stats=None):
     """The worklist algorithm for iterating a data flow analysis to a
     fixed point.
+
+    The worklist is a priority queue in `block_order`, and a block is
+    only queued once at a time. If `stats` is a dict, record the number
+    of times the transfer function ran in `stats['iterations']`.
     """
     preds, succs = cfg.edges(blocks)
 
+    # Summarize the blocks up front, so revisiting one doesn't rescan its
+    # instructions.
+    if analysis.summarize:
+        summaries = {name: analysis.summarize(block)
+                     for name, block in blocks.items()}
+    else:
+        summaries = blocks
+
     # Switch between directions.
     if analysis.forward:
         first_block = list(blocks.keys())[0]  # Entry.
@@ -40,19 +110,32 @@ def df_worklist(blocks, analysis):
     in_ = {first_block: analysis.init}
     out = {node: analysis.init for node in blocks}
 
-    # Iterate.
-    worklist = list(blocks.keys())
+    # Iterate. The worklist holds positions in the block order, so it
+    # starts out as a heap.
+    order = block_order(blocks, succs, analysis.forward)
+    priority = {node: i for i, node in enumerate(order)}
+    worklist = list(range(len(order)))
+    queued = set(order)
+    iterations = 0
     while worklist:
-        node = worklist.pop(0)
+        node = order[heapq.heappop(worklist)]
+        queued.remove(node)
 
         inval = analysis.merge(out[n] for n in in_edges[node])
         in_[node] = inval
 
-        outval = analysis.transfer(blocks[node], inval)
+        outval = analysis.transfer(summaries[node], inval)
+        iterations += 1
 
         if outval != out[node]:
             out[node] = outval
-            worklist += out_edges[node]
+            for succ in out_edges[node]:
+                if succ not in queued:
+                    queued.add(succ)
+                    heapq.heappush(worklist, priority[succ])
+
+    if stats is not None:
+        stats['iterations'] = iterations
 
     if analysis.forward:
         return in_, out
@@ -60,6 +143,54 @@ def df_worklist(blocks, analysis):
         return out, in_
 
 
+class DataflowResult:
+    """The solution of a data flow analysis over the blocks of a CFG.
+
+    `in_` and `out` hold the facts at the start and end of each block.
+    The facts at individual instructions are derived from those on
+    demand, by applying the transfer function to one instruction at a
+    time, and kept for each block that has been asked about.
+    """
+    def __init__(self, blocks, analysis, stats=None):
+        self.blocks = blocks
+        self.analysis = analysis
+        self.in_, self.out = df_worklist(blocks, analysis, stats)
+        self._facts = {}
+
+    def _step(self, instr, val):
+        part = [instr]
+        if self.analysis.summarize:
+            part = self.analysis.summarize(part)
+        return self.analysis.transfer(part, val)
+
+    def facts(self, block):
+        """Get the facts at every point in a block, in program order:
+        element `i` is the fact before instruction `i`, and the last
+        element is the fact after the last instruction.
+        """
+        if block not in self._facts:
+            instrs = self.blocks[block]
+            if self.analysis.forward:
+                facts = [self.in_[block]]
+                for instr in instrs:
+                    facts.append(self._step(instr, facts[-1]))
+            else:
+                facts = [self.out[block]]
+                for instr in reversed(instrs):
+                    facts.append(self._step(instr, facts[-1]))
+                facts.reverse()
+            self._facts[block] = facts
+        return self._facts[block]
+
+    def before(self, block, index):
+        """The fact just before instruction `index` of a block."""
+        return self.facts(block)[index]
+
+    def after(self, block, index):
+        """The fact just after instruction `index` of a block."""
+        return self.facts(block)[index + 1]
+
+
 def fmt(val):
     """Guess a good way to format a data flow value. (Works for sets and
     dicts, at least.)
@@ -79,17 +210,46 @@ def fmt(val):
         return str(val)
 
 
-def run_df(bril, analysis):
+def fmt_instr(instr):
+    """Format an instruction as a short line of text."""
+    parts = []
+    if 'dest' in instr:
+        parts += [instr['dest'], '=']
+    parts.append(instr['op'])
+    if 'value' in instr:
+        parts.append(json.dumps(instr['value']))
+    parts += ['@' + f for f in instr.get('funcs', [])]
+    parts += instr.get('args', [])
+    parts += ['.' + label for label in instr.get('labels', [])]
+    return ' '.join(parts)
+
+
+def run_df(bril, analysis, show_stats=False, decode=None,
+           show_instrs=False):
+    """Run an analysis on every function and print the facts at the
+    start and end of every block. With `show_instrs`, also print each
+    instruction followed by the fact just after it.
+    """
+    decode = decode or (lambda val: val)
     for func in bril['functions']:
         # Form the CFG.
         blocks = cfg.block_map(form_blocks(func['instrs']))
         cfg.add_terminators(blocks)
 
-        in_, out = df_worklist(blocks, analysis)
+        stats = {}
+        result = DataflowResult(blocks, analysis, stats)
+        if show_stats:
+            print('{}: {} iterations, {} blocks'.format(
+                func['name'], stats['iterations'], len(blocks),
+            ), file=sys.stderr)
         for block in blocks:
             print('{}:'.format(block))
-            print('  in: ', fmt(in_[block]))
-            print('  out:', fmt(out[block]))
+            print('  in: ', fmt(decode(result.in_[block])))
+            if show_instrs:
+                for i, instr in enumerate(blocks[block]):
+                    print('    {}'.format(fmt_instr(instr)))
+                    print('      ', fmt(decode(result.after(block, i))))
+            print('  out:', fmt(decode(result.out[block])))
 
 
 def gen(block):
@@ -110,14 +270,40 @@ def use(block):
     return used
 
 
-def cprop_transfer(block, in_vals):
-    out_vals = dict(in_vals)
+def gen_bits(block):
+    """Like `gen`, as a bit vector of `VARS`."""
+    return VARS.bits(i['dest'] for i in block if 'dest' in i)
+
+
+def use_bits(block):
+    """Like `use`, as a bit vector of `VARS`."""
+    defined = 0
+    used = 0
+    for i in block:
+        for v in i.get('args', []):
+            used |= VARS.bit(v) & ~defined
+        if 'dest' in i:
+            defined |= VARS.bit(i['dest'])
+    return used
+
+
+def cprop_summary(block):
+    """The values that the block leaves in the variables it writes: a
+    constant or '?'.
+    """
+    consts = {}
     for instr in block:
         if 'dest' in instr:
             if instr['op'] == 'const':
-                out_vals[instr['dest']] = instr['value']
+                consts[instr['dest']] = instr['value']
             else:
-                out_vals[instr['dest']] = '?'
+                consts[instr['dest']] = '?'
+    return consts
+
+
+def cprop_transfer(consts, in_vals):
+    out_vals = dict(in_vals)
+    out_vals.update(consts)
     return out_vals
 
 
@@ -143,7 +329,8 @@ ANALYSES = {
         True,
         init=set(),
         merge=union,
-        transfer=lambda block, in_: in_.union(gen(block)),
+        transfer=lambda gen_, in_: in_.union(gen_),
+        summarize=gen,
     ),
 
     # Live variable analysis: the variables that are both defined at a
@@ -152,7 +339,8 @@ ANALYSES = {
         False,
         init=set(),
         merge=union,
-        transfer=lambda block, out: use(block).union(out - gen(block)),
+        transfer=lambda summary, out: summary[0].union(out - summary[1]),
+        summarize=lambda block: (use(block), gen(block)),
     ),
 
     # A simple constant propagation pass.
@@ -161,9 +349,42 @@ ANALYSES = {
         init={},
         merge=cprop_merge,
         transfer=cprop_transfer,
+        summarize=cprop_summary,
+    ),
+}
+
+# Variable names for the bit-vector analyses.
+VARS = Interner()
+
+# Bit-vector versions of the set-based analyses above, which represent
+# sets of variables as ints.
+BIT_ANALYSES = {
+    'defined': Analysis(
+        True,
+        init=0,
+        merge=bit_union,
+        transfer=lambda gen_, in_: in_ | gen_,
+        summarize=gen_bits,
+    ),
+
+    'live': Analysis(
+        False,
+        init=0,
+        merge=bit_union,
+        transfer=lambda summary, out: summary[0] | (out & ~summary[1]),
+        summarize=lambda block: (use_bits(block), gen_bits(block)),
     ),
 }
 
 if __name__ == '__main__':
     bril = json.load(sys.stdin)
-    run_df(bril, ANALYSES[sys.argv[1]])
+    flags = sys.argv[2:]
+    if '-b' in flags:
+        if sys.argv[1] not in BIT_ANALYSES:
+            sys.exit('df.py: error: {} has no bit-vector form; -b supports: '
+                     '{}'.format(sys.argv[1], ', '.join(BIT_ANALYSES)))
+        run_df(bril, BIT_ANALYSES[sys.argv[1]], '-s' in flags, VARS.decode,
+               '-i' in flags)
+    else:
+        run_df(bril, ANALYSES[sys.argv[1]], '-s' in flags,
+               show_instrs='-i' in flags)
@@ -0,0 +1,92 @@
+"""Compare the set-based and bit-vector data flow analyses in `df.py`.
+
+Generates large synthetic CFGs, runs each analysis with both
+representations, checks that they agree, and reports the time each
+took. For example:
+
+    $ python3 dfbench.py --blocks 2000 --vars 500
+"""
+
+import argparse
+import random
+import time
+
+import cfg
+from form_blocks import form_blocks
+import df
+
+
+def synth_function(nblocks, nvars, block_size, rng):
+    """Generate a Bril function with `nblocks` basic blocks that read and
+    write `nvars` variables, with random branches between the blocks.
+    """
+    names = ['v{}'.format(i) for i in range(nvars)]
+    instrs = [{'op': 'const', 'dest': name, 'type': 'int', 'value': 0}
+              for name in names]
+    for i in range(nblocks):
+        instrs.append({'label': 'b{}'.format(i)})
+        for _ in range(block_size):
+            instrs.append({
+                'op': 'add',
+                'dest': rng.choice(names),
+                'type': 'int',
+                'args': [rng.choice(names), rng.choice(names)],
+            })
+        if i == nblocks - 1:
+            instrs.append({'op': 'ret', 'args': []})
+        elif rng.random() < 0.5:
+            instrs.append({'op': 'jmp', 'labels': ['b{}'.format(i + 1)]})
+        else:
+            # Branch forward to the next block or back to an earlier one,
+            # making loops.
+            instrs.append({
+                'op': 'br',
+                'args': [rng.choice(names)],
+                'labels': ['b{}'.format(i + 1),
+                           'b{}'.format(rng.randrange(i + 1))],
+            })
+    return {'name': 'main', 'instrs': instrs}
+
+
+def bench(func, analysis, decode=None):
+    blocks = cfg.block_map(form_blocks(func['instrs']))
+    cfg.add_terminators(blocks)
+
+    start = time.perf_counter()
+    in_, out = df.df_worklist(blocks, analysis)
+    elapsed = time.perf_counter() - start
+
+    if decode:
+        in_ = {name: decode(val) for name, val in in_.items()}
+        out = {name: decode(val) for name, val in out.items()}
+    return (in_, out), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--blocks', type=int, default=2000,
+                        help='basic blocks per function (default: 2000)')
+    parser.add_argument('--vars', type=int, default=500,
+                        help='variables per function (default: 500)')
+    parser.add_argument('--block-size', type=int, default=10,
+                        help='instructions per block (default: 10)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: 0)')
+    args = parser.parse_args()
+
+    func = synth_function(args.blocks, args.vars, args.block_size,
+                          random.Random(args.seed))
+    print('{:<8} {:>9} {:>9} {:>8}'.format(
+        'analysis', 'sets s', 'bits s', 'speedup',
+    ))
+    for name, bit_analysis in df.BIT_ANALYSES.items():
+        sets, set_time = bench(func, df.ANALYSES[name])
+        bits, bit_time = bench(func, bit_analysis, df.VARS.decode)
+        assert sets == bits, 'bit-vector {} analysis disagrees'.format(name)
+        print('{:<8} {:>9.3f} {:>9.3f} {:>7.1f}x'.format(
+            name, set_time, bit_time, set_time / bit_time,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,22 +18,25 @@ def map_inv(succ):
     return out
 
 
-def postorder_helper(succ, root, explored, out):
-    """Given a successor edge map, produce a list of all the nodes in
-    the graph in postorder by appending to the `out` list.
-    """
-    if root in explored:
-        return
-    explored.add(root)
-
-    for s in succ[root]:
-        postorder_helper(succ, s, explored, out)
-    out.append(root)
-
-
 def postorder(succ, root):
+    """Given a successor edge map, produce a list of all the nodes
+    reachable from `root` in postorder.
+    """
+    # Keep an explicit stack of nodes and their unexplored successors,
+    # so deep graphs don't overflow Python's stack.
     out = []
-    postorder_helper(succ, root, set(), out)
+    explored = {root}
+    stack = [(root, iter(succ[root]))]
+    while stack:
+        node, children = stack[-1]
+        for s in children:
+            if s not in explored:
+                explored.add(s)
+                stack.append((s, iter(succ[s])))
+                break
+        else:
+            stack.pop()
+            out.append(node)
     return out
 
 
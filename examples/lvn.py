@@ -262,7 +262,16 @@ def lvn(bril, prop=False, canon=False, fold=False):
         func['instrs'] = flatten(blocks)
 
 
+def optimize(bril, *flags):
+    """Apply `lvn` configured with command-line-style flags: `-p` for
+    copy propagation, `-c` for canonicalization, and `-f` for constant
+    folding.
+    """
+    lvn(bril, '-p' in flags, '-c' in flags, '-f' in flags)
+    return bril
+
+
 if __name__ == '__main__':
     bril = json.load(sys.stdin)
-    lvn(bril, '-p' in sys.argv, '-c' in sys.argv, '-f' in sys.argv)
+    optimize(bril, *sys.argv[1:])
     json.dump(bril, sys.stdout, indent=2, sort_keys=True)
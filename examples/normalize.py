@@ -1,45 +1,113 @@
+"""Normalize Brench results to a baseline run.
+
+Reads Brench's CSV on stdin and writes it back out with each result
+divided by the same benchmark's result for the baseline run (the run
+named `baseline`, or the name given as the first argument). Status
+results like `timeout` are passed through unchanged. Rows stream through
+as soon as their benchmark's baseline has been seen.
+"""
+
 import csv
+import math
 import sys
-from collections import defaultdict
-from statistics import geometric_mean
+from collections import Counter, defaultdict
 
-STATS = {
-    'geomean': geometric_mean,
-    'min': min,
-    'max': max,
-}
+STATS = ['geomean', 'min', 'max']
 
 
-def normalize():
-    # Read input CSV.
-    reader = csv.DictReader(sys.stdin)
-    in_data = list(reader)
+class RunStats:
+    """Running statistics over the normalized results of one run,
+    counting the rows that were left out by their result.
+    """
+    def __init__(self):
+        self.count = 0
+        self.log_sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.excluded = Counter()
+
+    def add(self, ratio):
+        self.count += 1
+        self.log_sum += math.log(ratio)
+        self.min = min(self.min, ratio)
+        self.max = max(self.max, ratio)
+
+    @property
+    def geomean(self):
+        return math.exp(self.log_sum / self.count)
+
 
-    # Get normalization baselines.
-    baselines = {
-        row['benchmark']: int(row['result'])
-        for row in in_data
-        if row['run'] == 'baseline'
-    }
+def parse_result(text):
+    """Get the number from a result, or None for a status."""
+    try:
+        return float(text)
+    except ValueError:
+        return None
 
-    # Write output CSV back out.
+
+def normalize(baseline='baseline'):
+    reader = csv.DictReader(sys.stdin)
     writer = csv.DictWriter(sys.stdout, reader.fieldnames)
     writer.writeheader()
-    ratios = defaultdict(list)
-    for row in in_data:
-        ratio = int(row['result']) / baselines[row['benchmark']]
-        ratios[row['run']].append(ratio)
-        row['result'] = ratio
+
+    baselines = {}  # Benchmark name to baseline result, or None.
+    pending = defaultdict(list)  # Rows waiting for their baseline.
+    stats = defaultdict(RunStats)
+
+    def emit(row, base):
+        result = parse_result(row['result'])
+        if result is None:
+            # Carry failures through as they are.
+            stats[row['run']].excluded[row['result']] += 1
+        elif not base:
+            row['result'] = 'no_baseline'
+            stats[row['run']].excluded['no_baseline'] += 1
+        else:
+            ratio = result / base
+            row['result'] = ratio
+            if ratio > 0:
+                stats[row['run']].add(ratio)
+            else:
+                stats[row['run']].excluded['nonpositive'] += 1
         writer.writerow(row)
 
+    for row in reader:
+        bench = row['benchmark']
+        if row['run'] == baseline:
+            baselines[bench] = parse_result(row['result'])
+            emit(row, baselines[bench])
+            for waiting in pending.pop(bench, []):
+                emit(waiting, baselines[bench])
+        elif bench in baselines:
+            emit(row, baselines[bench])
+        else:
+            pending[bench].append(row)
+
+    # These benchmarks have no baseline run at all.
+    for rows in pending.values():
+        for row in rows:
+            emit(row, None)
+
     # Print stats.
-    for run, rs in ratios.items():
-        for name, func in STATS.items():
+    for run, run_stats in stats.items():
+        if run_stats.count:
+            for name in STATS:
+                print(
+                    '{}({}) = {:.2f}'.format(name, run,
+                                             getattr(run_stats, name)),
+                    file=sys.stderr,
+                )
+        if run_stats.excluded:
             print(
-                '{}({}) = {:.2f}'.format(name, run, func(rs)),
+                'excluded({}) = {} ({})'.format(
+                    run,
+                    sum(run_stats.excluded.values()),
+                    ', '.join('{} {}'.format(n, status) for status, n
+                              in sorted(run_stats.excluded.items())),
+                ),
                 file=sys.stderr,
             )
 
 
 if __name__ == '__main__':
-    normalize()
+    normalize(*sys.argv[1:2])
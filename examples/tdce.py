@@ -120,16 +120,19 @@ MODES = {
 }
 
 
+def optimize(bril, mode='tdce'):
+    """Apply one of the `MODES` to every function in a program.
+    """
+    for func in bril['functions']:
+        MODES[mode](func)
+    return bril
+
+
 def localopt():
-    if len(sys.argv) > 1:
-        modify_func = MODES[sys.argv[1]]
-    else:
-        modify_func = trivial_dce
+    bril = json.load(sys.stdin)
 
     # Apply the change to all the functions in the input program.
-    bril = json.load(sys.stdin)
-    for func in bril['functions']:
-        modify_func(func)
+    optimize(bril, *sys.argv[1:2])
     json.dump(bril, sys.stdout, indent=2, sort_keys=True)
 
 